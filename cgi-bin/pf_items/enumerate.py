@@ -25,11 +25,18 @@ the standard item generation methods, and can act as a test.
 from __future__ import print_function
 
 import argparse
+import hashlib
+import multiprocessing
 import os
 import sqlite3 as sqlite
 import sys
 import traceback
 
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
+
 
 #
 # Local imports
@@ -46,140 +53,95 @@ STANDARD_STRENGTHS = ['lesser minor', 'greater minor', 'lesser medium',
 EXPANDED_STRENGTHS = ['least minor', 'lesser minor', 'greater minor',
         'lesser medium', 'greater medium', 'lesser major', 'greater major']
 
+# Item kinds to enumerate: the item key, its strengths, and the prefix of the
+# output table names.
+ENUMERATED_KINDS = [
+        ('armor/shield', STANDARD_STRENGTHS, 'armor'),
+        ('weapon', STANDARD_STRENGTHS, 'weapon'),
+        ('potion', STANDARD_STRENGTHS, 'potion'),
+        ('ring', STANDARD_STRENGTHS, 'ring'),
+        ('rod', STANDARD_STRENGTHS, 'rod'),
+        ('scroll', STANDARD_STRENGTHS, 'scroll'),
+        ('staff', STANDARD_STRENGTHS, 'staff'),
+        ('wand', STANDARD_STRENGTHS, 'wand'),
+        ('wondrous', EXPANDED_STRENGTHS, 'wondrous')]
+
 
 #
 # Global Variables
 
-ENABLE_SKIPPING = False
 PRINT_ROLLS = False
 OUTPUT_PREFIX = 'enum'
 
+# The input database connection of a worker process (see init_worker).
+WORKER_CONN = None
+
 
 #
 # Classes
 
-class EnumerationsComplete(Exception):
-    pass
-
-# This roller does not roll random at all.  Instead, it gives out sequential
-# values, so that everything can be enumerated.
-class EnumeratingRoller(rollers.Roller):
+# This roller does not roll at all.  Instead, it is handed each table lookup
+# as it happens, and picks one of the table's rows to follow.  Every distinct
+# path through the tables is walked once, depth first, by replaying the item
+# generation with the choices made so far, and advancing the last one.  The
+# weight of a path is the product of the number of d100 rolls that select
+# each of its rows.
+class BranchingEnumerator(rollers.Roller):
 
     def __init__(self):
-        self.current = {}
-        self.purposes1 = []
-        self.purposes2 = []
-        self.stage = 1
-        self.last_purpose = None
-        self.rightmost_purpose = None
-        self.rolls = {}
+        rollers.Roller.__init__(self)
+        # The choices made on the current path, as [purpose, branch position,
+        # number of branches] lists, one per table lookup.
+        self.path = []
+        # Number of lookups made so far for the current item.
+        self.depth = 0
+        # Number of d100 rolls (out of 100 ** depth) selecting this path.
+        self.weight = 1
+        # Names of every item table looked up, on any path.
+        self.tables = set()
 
     def begin_item(self):
-        self.rolls = {}
+        self.depth = 0
+        self.weight = 1
 
     def end_item(self):
-        pass
-
-    def item_rolled(self, purpose, range_low, range_high, strength):
-        if purpose not in self.rolls or range_high > self.rolls[purpose][1]:
-            self.rolls[purpose] = (range_low, range_high, strength)
-
-    def do_skip(self):
-        if not ENABLE_SKIPPING:
-            return 1
-        multiplier = 1
-        for purpose in self.purposes1:
-            try:
-                low, high, strength = self.rolls[purpose]
-                span = high - low + 1
-                multiplier = multiplier * span
-                self.current[purpose]['value'] = high
-            except KeyError as ex:
-                # Simply omit it from the calculation. If there was no value,
-                # it's not important.
-                pass
-        self.rolls = {}
-        return multiplier
+        # Anything past the lookups actually made belongs to an older path.
+        del self.path[self.depth:]
 
     def roll(self, dice_expression, purpose):
-        # If this purpose has not been used yet, set it up.
-        if purpose not in self.current.keys():
-            # Determine the maximum on the die.
-            # If there is more than one die, probability-wise, the resulting
-            # sequence won't generate a list of items in the probability they
-            # would be generated with random rolls, but that'll be okay, since
-            # we'll be using this for 1d100s.  If that ever turns out not to
-            # be true, this idea will still work, but it'll have to be changed
-            # to generate higher probability numbers multiple times.
-            (number, sides) = rollers.parseDiceExpression(dice_expression)
-            # Set the current value to 0, so we can increment then return.
-            self.current[purpose] = {'max': number * sides,
-                    'value': 1}
-
-        # States:
-        # Round 1: initial values
-        # Round 2: confirmation pass
-        # Round 3: clear and increment based on round 2 values
-
-        # Check state transitions.
-        if self.stage == 1:
-            # We advance to state 2 when the purpose is an old one, but not
-            # most recent one.
-            if purpose in self.purposes1 and purpose != self.last_purpose:
-                self.stage = 2
-                self.rightmost_purpose = self.last_purpose
-        elif self.stage == 2:
-            # We advance to state 3 like 1 to 2.
-            if purpose in self.purposes2 and purpose != self.last_purpose:
-                self.stage = 3
-
-        # If we're repeating the last request, increment it.
-        if purpose == self.last_purpose:
-            if self.increment():
-                raise EnumerationsComplete
-
-        # Note the last purpose.
-        self.last_purpose = purpose
-
-        # Handle the state.
-        if self.stage == 1:
-            # This is the first pass.
-            if purpose not in self.purposes1:
-                self.purposes1.append(purpose)
-        elif self.stage >= 2 and purpose == self.last_purpose:
-            # Increment
-            if self.increment():
-                raise EnumerationsComplete
-            # Restart purposes not in the list.
-            for key in self.current.keys():
-                if key not in self.purposes1:
-                    self.current[key]['value'] = 1
-            # Clear the purpose tracking lists.
-            self.purposes1 = []
-            self.purposes2 = []
-            # Since stage 3 is effectively a preemptive 1, make it look like
-            # the first part of a new 1 occurred.
-            self.purposes1.append(purpose)
-            self.stage = 1
-            self.last_purpose = None
-        return self.current[purpose]['value']
-
-    def increment(self):
-        # Increment according to the reverse of the purpose lists.
-        for digit in reversed(self.purposes1):
-            # Increment the purpose current value.
-            self.current[digit]['value'] += 1
-            value = self.current[digit]['value']
-            # If the purpose value rolls over
-            if value > self.current[digit]['max']:
-                # Start it over at zero and let the loop continue.
-                self.current[digit]['value'] = 1
-            else:
-                # We were able to increment without carrying.
-                # This needs to happen just once somewhere.
-                return False
-        # We incremeneted all the way past the end.
-        return True
+        # The rolls are ignored: choose_branch decides the results.
+        return 0
+
+    def choose_branch(self, table, purpose, branches):
+        '''Called by item.Table.find_roll.  Returns the index of the row to
+        follow, or -1 for rolls no row covers.'''
+        self.tables.add(table)
+        if not branches:
+            return -1
+        if self.depth == len(self.path):
+            # A new lookup: start with its first branch.
+            self.path.append([purpose, 0, len(branches)])
+        choice = self.path[self.depth]
+        (index, weight) = branches[choice[1]]
+        self.depth += 1
+        self.weight *= weight
+        return index
+
+    def advance(self):
+        '''Moves on to the next path.  Returns False when all of them have
+        been walked.'''
+        while self.path:
+            choice = self.path[-1]
+            choice[1] += 1
+            if choice[1] < choice[2]:
+                return True
+            self.path.pop()
+        return False
+
+    def path_str(self):
+        return ', '.join(['{0} {1}/{2}'.format(purpose, position + 1, count)
+            for (purpose, position, count) in self.path])
+
 
 #
 # Functions
@@ -190,137 +152,241 @@ def prep_table(cursor, table):
     cursor.execute(sql)
 
 
-def enumerate_item(conn_in, conn_out, strengths, item_key, file_prefix):
-    # Roll up items
-    for strength in strengths:
-        print('Analyzing', strength, item_key)
-        roller = EnumeratingRoller()
-
-        # Set up the output file or table name.
-        filename = file_prefix + '_' + strength
-        filename = filename.replace(' ', '_')
-        filepath = OUTPUT_PREFIX + '/' + filename
-        f_rollfile = None
-
-        if conn_out == None:
-            f_rollfile = open(filepath + '.rolls', 'w')
-
-        # Collect items to count.
-        items = {}
-        # Roll items
-        while True:
-            try:
-                # Notify the roller it's about to roll a single item.
-                roller.begin_item()
-                # Roll the item.
-                x = item.generate_specific_item(conn_in, strength, item_key,
-                        roller, roller)
-                # Done rolling an item.
-                roller.end_item()
-                # Allow the roller to increment based on its saved values.
-                count = roller.do_skip()
-                # Get the rolls.
-                roll = item.rolls_str(x)
-                if PRINT_ROLLS:
-                    if f_rollfile:
-                        print(      roll + '           \n', end='', file=f_rollfile)
-                    print(' ' + roll + '           \r', end='')
-                # Store the item quantity.
-                item_str = item.item_str(x)
-                if item_str in items.keys():
-                    items[item_str]['count'] += count
-                else:
-                    items[item_str] = {'count': count, 'item': x}
-            except EnumerationsComplete:
-                # Done!
+def get_table_name(file_prefix, strength):
+    '''Returns the output table (or file) name for a kind and strength.'''
+    return (file_prefix + '_' + strength).replace(' ', '_')
+
+
+def enumerate_item(conn_in, strength, item_key, file_prefix):
+    '''Enumerates every item of one kind and strength.  Returns the output
+    table name, a list of (count, item string, is bad, kind, subtype, label,
+    price) tuples, one per distinct item, and the names of the item tables
+    the items came from.'''
+    print('Analyzing', strength, item_key)
+    roller = BranchingEnumerator()
+
+    # Set up the output file or table name.
+    filename = get_table_name(file_prefix, strength)
+    filepath = OUTPUT_PREFIX + '/' + filename
+    f_rollfile = None
+
+    if PRINT_ROLLS:
+        f_rollfile = open(filepath + '.rolls', 'w')
+
+    # Collect items to count.  Each item's weight is kept per depth,
+    # since a path of n lookups is weighed out of 100 ** n.
+    items = {}
+    max_depth = 0
+    # Walk every path through the tables.
+    while True:
+        # Notify the roller it's about to roll a single item.
+        roller.begin_item()
+        # Roll the item.
+        x = item.generate_specific_item(conn_in, strength, item_key,
+                roller, roller)
+        # Done rolling an item.
+        roller.end_item()
+        if f_rollfile:
+            print(roller.path_str(), file=f_rollfile)
+        # Store the item weight.
+        item_str = item.item_str(x)
+        if item_str not in items:
+            items[item_str] = {'weights': {}, 'item': x}
+        weights = items[item_str]['weights']
+        weights[roller.depth] = weights.get(roller.depth, 0) + \
+                roller.weight
+        max_depth = max(max_depth, roller.depth)
+        # Move on to the next path.
+        if not roller.advance():
+            break
+
+    if f_rollfile:
+        f_rollfile.close()
+
+    # Bring the weights to a common denominator, and reduce them.
+    divisor = 0
+    for xdict in items.values():
+        xdict['count'] = sum([weight * 100 ** (max_depth - depth)
+            for (depth, weight) in xdict['weights'].items()])
+        divisor = gcd(divisor, xdict['count'])
+
+    # Keep only plain values, so the results can be sent between processes.
+    results = []
+    total = 0
+    for item_str in items.keys():
+        xdict = items[item_str]
+        count = xdict['count'] // divisor
+        x = xdict['item']
+        total += count
+        results.append((count, item_str, x.is_bad(), x.kind, x.subtype,
+            x.label, x.price.as_float()))
+
+    print('   ', strength, item_key, 'contained', total, 'items')
+    return (filename, results, sorted(roller.tables))
+
+
+def write_results(conn_out, filename, results):
+    '''Writes one enumerated table, to the output database if there is one,
+    otherwise to a text file.'''
+    if conn_out:
+        # The filename serves as a table name.
+        cursor = conn_out.cursor()
+        cursor.execute('DROP TABLE IF EXISTS {0};'.format(filename))
+        prep_table(cursor, filename)
+        sql = 'INSERT INTO {0} VALUES (?,?,?,?,?)'.format(filename)
+        # Do not include bad items in the database file.
+        # count, kind, subtype, label, cost
+        cursor.executemany(sql, [(count, kind, subtype, label, price)
+            for (count, item_str, bad, kind, subtype, label, price) in results
+            if not bad])
+    else:
+        # Text mode is for inspection, so include bad items.
+        with open(OUTPUT_PREFIX + '/' + filename + '.txt', 'w') as f_out:
+            for (count, item_str, bad, kind, subtype, label, price) in results:
+                print(count, item_str, 'invalid' if bad else 'valid',
+                        sep='\t', file=f_out)
+
+
+def get_table_hash(conn_in, table, hashes):
+    '''Returns a hash of the rows of an item table, or None if there is no
+    such table.  Hashes are cached in the dict 'hashes'.'''
+    if table not in hashes:
+        digest = hashlib.sha1()
+        try:
+            for row in conn_in.execute(
+                    'SELECT * FROM {0} ORDER BY rowid;'.format(table)):
+                digest.update(repr(tuple(row)).encode('utf-8'))
+            hashes[table] = digest.hexdigest()
+        except sqlite.Error:
+            hashes[table] = None
+    return hashes[table]
+
+
+def write_sources(conn_in, conn_out, filename, tables, hashes):
+    '''Records the item tables, and their hashes, that an enumerated table
+    was built from.'''
+    sql = 'DELETE FROM {0} WHERE Enum_Table = ?;'.format(
+            item.FREQUENCY_SOURCES_TABLE)
+    conn_out.execute(sql, (filename,))
+    sql = 'INSERT INTO {0} VALUES (?,?,?);'.format(
+            item.FREQUENCY_SOURCES_TABLE)
+    conn_out.executemany(sql, [(filename, table,
+        get_table_hash(conn_in, table, hashes)) for table in tables])
+
+
+def get_stale_jobs(conn_in, conn_out, job_list, hashes):
+    '''Returns the jobs whose output tables are missing from the output
+    database, or were built from item tables that have changed since.'''
+    existing = set([row[0] for row in conn_out.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table';")])
+    sources = {}
+    for row in conn_out.execute(
+            'SELECT Enum_Table, Source_Table, Hash FROM {0};'.format(
+                item.FREQUENCY_SOURCES_TABLE)):
+        sources.setdefault(row[0], []).append((row[1], row[2]))
+    stale = []
+    for job in job_list:
+        (strength, item_key, file_prefix) = job
+        filename = get_table_name(file_prefix, strength)
+        if filename not in existing or filename not in sources:
+            stale.append(job)
+            continue
+        for (table, table_hash) in sources[filename]:
+            if get_table_hash(conn_in, table, hashes) != table_hash:
+                stale.append(job)
                 break
+    return stale
 
-        cursor = None
-        f_out = None
-        if conn_out:
-            cursor = conn_out.cursor()
-            # The filename serves as a table name.
-            prep_table(cursor, filename)
-        else:
-            f_out = open(filepath + '.txt', 'w')
 
-        # Output the results.
-        total = 0
-        sql = 'INSERT INTO {0} VALUES (?,?,?,?,?)'.format(filename)
-        for item_str in items.keys():
-            xdict = items[item_str]
-            count = xdict['count']
-            x = xdict['item']
-            total += count
-
-            if cursor:
-                # Do not include bad items in the database file.
-                if not x.is_bad():
-                    # count, kind, subtype, label, cost
-                    cursor.execute(sql, (count, x.kind, x.subtype, x.label, \
-                        x.price.as_float()) )
-            else:
-                # Text mode is for inspection, so include bad items.
-                if x.is_bad:
-                    print(items[item_str], item_str, 'invalid', sep='\t', file=f_out)
-                else:
-                    print(items[item_str], item_str, 'valid', sep='\t', file=f_out)
-
-        print('    contained', total, 'items')
-
-        # Close files.
-        if f_out:
-            f_out.close();
-        if f_rollfile:
-            f_rollfile.close()
-        if conn_out:
-            conn_out.commit()
+def get_jobs():
+    '''Lists the (strength, item key, file prefix) of every table to
+    enumerate, in output order.'''
+    return [(strength, item_key, file_prefix)
+            for (item_key, strengths, file_prefix) in ENUMERATED_KINDS
+            for strength in strengths]
+
+
+def init_worker(database_in, print_rolls, output_prefix):
+    '''Sets up a worker process with its own read-only input connection.'''
+    global WORKER_CONN, PRINT_ROLLS, OUTPUT_PREFIX
+    PRINT_ROLLS = print_rolls
+    OUTPUT_PREFIX = output_prefix
+    item.set_enumeration()
+    WORKER_CONN = initialize_database(database_in, read_only=True)
 
 
-def build_enum_table(conn_in, conn_out):
+def run_job(job):
+    '''Enumerates one table in a worker process.'''
+    (strength, item_key, file_prefix) = job
+    return enumerate_item(WORKER_CONN, strength, item_key, file_prefix)
+
+
+def build_enum_table(conn_in, conn_out, database_in=None, jobs=1,
+        incremental=False):
+    '''Enumerates every kind and strength of item.  With more than one job,
+    the tables are enumerated by a pool of worker processes, each opening
+    'database_in' itself.  The results are written in a single transaction
+    once they are all in.  If 'incremental' is set, only the tables whose
+    item tables have changed since the output database was built are
+    enumerated again.'''
 
     # Create the output directory.
     try:
         os.mkdir(OUTPUT_PREFIX)
     except FileExistsError:
         pass
-    
+
+    # Note which item tables each output table comes from, so that later
+    # builds can tell which ones are out of date.
+    hashes = {}
+    if conn_out:
+        conn_out.execute('CREATE TABLE IF NOT EXISTS {0} (Enum_Table TEXT, '
+                'Source_Table TEXT, Hash TEXT);'.format(
+                    item.FREQUENCY_SOURCES_TABLE))
+
     # Enumerate items for each class.
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'armor/shield', 'armor')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'weapon', 'weapon')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'potion', 'potion')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'ring', 'ring')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'rod', 'rod')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'scroll', 'scroll')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'staff', 'staff')
-    enumerate_item(conn_in, conn_out,
-            STANDARD_STRENGTHS, 'wand', 'wand')
-    enumerate_item(conn_in, conn_out,
-            EXPANDED_STRENGTHS, 'wondrous', 'wondrous')
+    job_list = get_jobs()
+    if incremental and conn_out:
+        job_list = get_stale_jobs(conn_in, conn_out, job_list, hashes)
+        print(len(job_list), 'tables out of date')
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker,
+                (database_in, PRINT_ROLLS, OUTPUT_PREFIX))
+        try:
+            # One table per task: their sizes vary too much to batch them.
+            results = pool.map(run_job, job_list, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [enumerate_item(conn_in, strength, item_key, file_prefix)
+                for (strength, item_key, file_prefix) in job_list]
+
+    # Write everything out.
+    for (filename, rows, tables) in results:
+        write_results(conn_out, filename, rows)
+        if conn_out:
+            write_sources(conn_in, conn_out, filename, tables, hashes)
 
     # If database, commit.
     if conn_out:
         conn_out.commit()
 
 
-def initialize_database(database_file):
+def initialize_database(database_file, read_only=False):
     conn = None
     successful = False
     try:
         # Open the database file.
-        conn = sqlite.connect(database_file)
-        conn.row_factory = sqlite.Row
+        if read_only:
+            conn = item.connect_read_only(database_file)
+        else:
+            conn = sqlite.connect(database_file)
+            conn.row_factory = sqlite.Row
         successful = True
     except sqlite.Error as e:
         # Print an error and exit.
-        print('Error: %s' % e.message)
+        print('Error: %s' % e)
         sys.exit(1)
     finally:
         if not successful and conn:
@@ -335,18 +401,9 @@ def run_program(args):
     item.set_enumeration()
 
     # Flags for the file/directory string.
-    n_cache = 0
-    n_skip = 0
     n_print_rolls = 0
 
     # Set the options.
-    if args.cache:
-        item.enable_caching(args.cache)
-        n_cache = args.cache
-    if args.skip:
-        global ENABLE_SKIPPING
-        ENABLE_SKIPPING = True
-        n_skip = 1
     if args.print_rolls:
         global PRINT_ROLLS
         PRINT_ROLLS = True
@@ -356,14 +413,14 @@ def run_program(args):
     global OUTPUT_PREFIX
     if args.prefix:
         OUTPUT_PREFIX = args.prefix
-    OUTPUT_PREFIX = OUTPUT_PREFIX + '_c{0}_s{1}_r{2}'.format(n_cache, n_skip, n_print_rolls)
+    OUTPUT_PREFIX = OUTPUT_PREFIX + '_r{0}'.format(n_print_rolls)
 
     # If the output is a database, set it up.
     conn_out = None
     if args.database:
-        # Remove the existing database file.
+        # Remove the existing database file, unless it is being updated.
         db_filename = OUTPUT_PREFIX + '.db'
-        if os.path.isfile(db_filename):
+        if os.path.isfile(db_filename) and not args.incremental:
             os.remove(db_filename)
         conn_out = initialize_database(db_filename)
         if not conn_out:
@@ -371,10 +428,11 @@ def run_program(args):
             sys.exit(1)
 
     # Initialize the INPUT database.
-    conn_in = initialize_database(args.database_in)
+    conn_in = initialize_database(args.database_in, read_only=True)
 
     # Build the enumeration table!
-    build_enum_table(conn_in, conn_out)
+    build_enum_table(conn_in, conn_out, args.database_in, args.jobs,
+            args.incremental)
 
 
 #
@@ -402,19 +460,19 @@ if __name__ == '__main__':
     parser.add_argument('--database', '-d', action='store_true',
             help='Output to a database file instead of a directory')
 
-    # Whether to use a cache, and the type (a number).
-    # The number is meaningful in item.py.
-    parser.add_argument('--cache', type=int,
-            help='The type of cache to use')
+    # Whether to print the table rows taken as items are generated (as a kind
+    # of progress report).
+    parser.add_argument('--print-rolls', '-r', action='store_true',
+            help='Prints the table rows taken for each item')
 
-    # Whether to save time by skipping rolls according to a heuristic.
-    parser.add_argument('--skip', action='store_true',
-            help='Skip rolls that would repeat previous return')
+    # Whether to keep the existing output database, and only enumerate the
+    # tables whose item tables have changed.
+    parser.add_argument('--incremental', '-i', action='store_true',
+            help='Only rebuild tables whose sources changed (with -d)')
 
-    # Whether to print the rolls as items are generated (as a kind of progress
-    # report.
-    parser.add_argument('--print-rolls', '-r', action='store_true',
-            help='Prints rolls')
+    # Number of worker processes enumerating tables at the same time.
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+            help='Number of tables to enumerate in parallel (default 1)')
 
     # Go.
     args = parser.parse_args()
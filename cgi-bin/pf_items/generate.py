@@ -17,10 +17,16 @@ This module acts as the command line interface for the Pathfinder Item
 Generator.
 '''
 
+from __future__ import print_function
+
 #
 # Standard Imports
 
 import argparse
+import csv
+import json
+import multiprocessing
+import os
 import re
 import sqlite3 as sqlite
 import sys
@@ -53,15 +59,29 @@ def run_generate_settlement(conn, args):
     if args.manual:
         roller = rollers.ManualDiceRoller()
     else:
-        roller = rollers.PseudorandomRoller()
+        roller = rollers.PseudorandomRoller(log_rolls=False)
     # Generate items.
     settlement = (' '.join(args.settlement_type)).lower()
-    result = settlements.generate_settlement_items(conn, settlement, roller)
+    # Use the enumerated items, if they have been built.
+    freq_conn = None
+    if os.path.isfile('data/freq.db'):
+        freq_conn = item.connect_read_only('data/freq.db')
+    try:
+        result = settlements.generate_settlement_items(conn, settlement,
+                roller, freq_conn=freq_conn)
+    finally:
+        if freq_conn: freq_conn.close()
     # Print the results.
-    print('Magic items for a ', settlement, ':', sep='')
+    print_settlement('Magic items for a ' + settlement + ':', result)
+
+
+def print_settlement(title, result):
+    '''Prints a settlement's items under a title.'''
+    print(title)
     print('-' * 78)
-    print('Base value:', result['base_value'], 'gp')
-    print()
+    if 'base_value' in result:
+        print('Base value:', result['base_value'], 'gp')
+        print()
     if len(result['minor_items']) > 0:
         print('Minor Magic Items')
         print('-' * 78)
@@ -81,13 +101,69 @@ def run_generate_settlement(conn, args):
             item.print_item(x)
 
 
+def read_region(args):
+    '''Reads the settlements of a region from the command line, as NAME=SIZE,
+    and from a CSV file, if one is given.  The file's header names its
+    columns: 'name', then either 'size', or the parameters of a custom
+    settlement ('base_value', 'q_ls_min', and so on).  Returns a list of
+    (name, parameters) pairs for settlements.generate_region.'''
+    region = []
+    for arg in args.settlements:
+        (name, sep, size) = arg.rpartition('=')
+        region.append((name or size, {'size': size}))
+    if args.csv:
+        if args.csv == '-':
+            f = sys.stdin
+        elif sys.version_info[0] < 3:
+            f = open(args.csv, 'rb')
+        else:
+            f = open(args.csv, newline='')
+        try:
+            for row in csv.DictReader(f):
+                name = row.pop('name', '')
+                params = dict((k, v.strip()) for (k, v) in row.items()
+                        if k and v and v.strip())
+                region.append((name, params))
+        finally:
+            if f is not sys.stdin: f.close()
+    return region
+
+
+def run_generate_region(conn, args):
+    '''Runs the settlement item generator for many settlements at once.  Exits
+    with status 1 if any settlement could not be generated.'''
+    region = read_region(args)
+    errors = 0
+    # Use the enumerated items, if they have been built.
+    freq_database = None
+    if os.path.isfile('data/freq.db'):
+        freq_database = 'data/freq.db'
+    # Print each settlement as soon as it is done.
+    for (name, result) in settlements.generate_region(region, 'data/data.db',
+            freq_database, args.jobs):
+        if args.json:
+            result['name'] = name
+            print(json.dumps(result))
+        elif 'error' in result:
+            print(name + ':', result['error'])
+            print()
+        else:
+            print_settlement(name + ':', result)
+            print('\n')
+        sys.stdout.flush()
+        if 'error' in result:
+            errors += 1
+    if errors > 0:
+        sys.exit(1)
+
+
 def run_generate_item(conn, args):
     '''Runs the individual item generator.'''
     # Set up the roller.
     if args.manual:
         roller = rollers.ManualDiceRoller()
     else:
-        roller = rollers.PseudorandomRoller()
+        roller = rollers.PseudorandomRoller(log_rolls=False)
     # Generate an item.
     keywords = (' '.join(args.item_args)).lower()
     x = item.generate_item(conn, keywords, roller, None)
@@ -103,14 +179,23 @@ def run_generate_fast(conn, args):
         count = args.count
     print('Fast-generating', count, 'items')
     for i in range(count):
-        try:
-            result = item.fast_generate(conn, args.strength, 
-                    args.kind, args.gold)
-            print('Item:',result[0], str(item.Price(result[1])))
-        except:
+        x = item.fast_generate_full(conn, args.strength, args.kind,
+                args.gold)
+        if x is None:
             print('No eligible items')
             # If none for one run, none for any
             return
+        print('Item:', item.item_str(x) + '; ' + str(x.price))
+
+
+def run_check_tables(conn, args):
+    '''Compiles the roll tables and reports gaps and overlaps.'''
+    item.TABLE_STORE.load(conn)
+    for problem in item.TABLE_STORE.problems:
+        print(problem)
+    print(len(item.TABLE_STORE.names), 'tables checked,',
+            len(item.TABLE_STORE.problems), 'problems found')
+
 
 class NotEnoughRolls(BaseException):
     pass
@@ -177,6 +262,27 @@ if __name__ == '__main__':
             make_series(settlements.get_keys()) )
     parser_settlement.set_defaults(func=run_generate_settlement)
 
+    # Subcommand: region
+
+    # Generate items for many settlements
+    parser_region = subparsers.add_parser('region',
+            help='Generates magic items for many settlements at once.')
+
+    parser_region.add_argument('settlements',
+            metavar='NAME=SIZE', nargs='*',
+            help='A settlement name and size, such as Sandpoint=village')
+    parser_region.add_argument('--csv', '-c', metavar='FILE',
+            help='A CSV file of settlements, with a header naming the ' +
+            'columns: name, and size or custom settlement parameters ' +
+            '(base_value, q_ls_min, ...); - reads standard input')
+    parser_region.add_argument('--jobs', '-j', type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of settlements to generate in parallel ' +
+            '(default: one per CPU)')
+    parser_region.add_argument('--json', action='store_true',
+            help='Prints each settlement as a line of JSON')
+    parser_region.set_defaults(func=run_generate_region)
+
     # Subcommand: individual item
 
     parser_item = subparsers.add_parser('item',
@@ -225,6 +331,12 @@ if __name__ == '__main__':
 
     parser_lookup.set_defaults(func=run_lookup)
 
+    # Subcommand: check the roll tables
+
+    parser_tables = subparsers.add_parser('tables',
+            help='Check the roll tables for gaps and overlapping rolls')
+    parser_tables.set_defaults(func=run_check_tables)
+
     # Options common to several subparsers
 
     for sub in [parser_settlement, parser_item]:
@@ -236,8 +348,7 @@ if __name__ == '__main__':
 
     # Undocumented subcommmand.
     if len(sys.argv) == 2 and sys.argv[1] == 'test':
-        conn = sqlite.connect('data/data.db')
-        conn.row_factory = sqlite.Row
+        conn = item.connect_read_only('data/data.db')
         run_test(conn, [])
         sys.exit(0)
 
@@ -248,10 +359,9 @@ if __name__ == '__main__':
     conn = None
     try:
         if args.subparser_name == 'fastitem':
-            conn = sqlite.connect('data/freq.db')
+            conn = item.connect_read_only('data/freq.db')
         else:
-            conn = sqlite.connect('data/data.db')
-        conn.row_factory = sqlite.Row
+            conn = item.connect_read_only('data/data.db')
         args.func(conn, args)
     except sqlite.Error as e:
         print('SQL Error: %s' % e.message)
@@ -22,35 +22,25 @@ generation.
 
 from __future__ import print_function
 
-import locale
+import array
 import math
-import os
 import random
 import re
 import sys
 import traceback
 
+try:
+    from math import gcd
+except ImportError:
+    # Python 2
+    from fractions import gcd
+
 #
 # Local imports
 
 import item
 import rollers
 
-#
-# Module initialization
-
-if os.name == 'posix':
-    # An extremely recognizable locale string.
-    locale.setlocale(locale.LC_ALL, 'en_US')
-elif os.name == 'nt':
-    # Windows doesn't use the sensible value.
-    locale.setlocale(locale.LC_ALL, 'enu')
-else:
-    # My best guess for other OSes.
-    try: locale.setlocale(locale.LC_ALL, 'en_US')
-    except: pass
-
-
 #
 # Constants
 
@@ -77,10 +67,29 @@ MAGNITUDES = {
         'triple': 3.0,
         }
 
+# Most treasure lots generated per treasure type, except when streaming.
+MAX_TREASURE_LOTS = 100
+
+# Most treasure lots generated per treasure type when streaming.  It is far
+# higher, but a request must still come to an end.
+MAX_STREAMED_TREASURE_LOTS = 10000
+
+# Largest budget, in gp, that lots can be fitted to (see fit_treasure).
+MAX_FIT_BUDGET = 1000000
+
+# Most distinct totals fit_treasure keeps track of.  Beyond this, costs are
+# rounded up to coarser units, so the fit may fall a little short of the best.
+MAX_FIT_UNITS = 1 << 18
+
+# Coin types, in the order their totals are listed.
+COIN_TYPES = ('cp', 'sp', 'gp', 'pp')
+
 
 #
 # Variables
 
+# Compiled treasure lots, by description (see compile_treasure_lot).
+TREASURE_LOTS = {}
 
 #
 # Functions
@@ -137,6 +146,7 @@ def lookup_treasure_type(conn, type_code, result):
     i = 0
     for row in conn.execute(sql):
         cost = item.Price(row[0])
+        compile_treasure_lot(row[1])
         result[type_code].append({
             'index': i, 'cost': int(cost.as_float()),
             'item': row[0], 'description': row[1],
@@ -151,47 +161,195 @@ def get_treasure_list(conn, types):
     return result
 
 
+def compile_treasure_lot(description):
+    '''Returns the plans for the treasure expressions in a lot description,
+    compiling them only the first time.'''
+    try:
+        return TREASURE_LOTS[description]
+    except KeyError:
+        pass
+    exprs = [x.strip().lower() for x in description.split(', ')]
+    plans = tuple(item.compile_treasure_item(expr) for expr in exprs)
+    TREASURE_LOTS[description] = plans
+    return plans
+
+
 def generate_treasure_lot(conn, description, roller, listener):
+    return execute_treasure_lot(conn, compile_treasure_lot(description),
+            roller, listener)
+
+
+def execute_treasure_lot(conn, plans, roller, listener):
     results = []
-    exprs = [x.strip().lower() for x in description.split(', ')]
-    for expr in exprs:
-        x = item.generate_treasure_item(conn, expr, roller, listener)
+    for plan in plans:
+        x = plan.execute(conn, roller, listener)
         if x: results.extend(x)
     return results
 
 
-def generate_treasure_type(conn, subspec, roller, listener):
-    result = []
-    for item in subspec:
-        for i in range(item['count']):
-            x = generate_treasure_lot(conn, item['description'],
-                    roller, listener)
-            if x: result.extend(x)
-    return result
+def iter_treasure_type(conn, subspec, roller, listener, coins=None):
+    '''Yields the treasure for the lots in 'subspec', one result at a time.
+    Coins are not yielded, but added to 'coins', a dict of the number of
+    each coin type; without one, their total is yielded last.'''
+    purse = coins if coins is not None else {}
+    for lot in subspec:
+        count = lot['count']
+        if count <= 0: continue
+        plans = compile_treasure_lot(lot['description'])
+        # Roll each kind of coins for every lot at once.
+        others = []
+        for plan in plans:
+            if isinstance(plan, item.TreasureCoins):
+                purse[plan.coinage] = (purse.get(plan.coinage, 0) +
+                        plan.roll_many(count))
+            else:
+                others.append(plan)
+        if not others: continue
+        for i in range(count):
+            x = execute_treasure_lot(conn, others, roller, listener)
+            if x:
+                for result in x:
+                    yield result
+    if coins is None and purse:
+        yield format_coins(purse)
 
 
-def generate_treasure(conn, requests, roller, listener):
+def generate_treasure_type(conn, subspec, roller, listener):
+    return list(iter_treasure_type(conn, subspec, roller, listener))
+
+
+def format_coins(coins):
+    '''Formats the number of each coin type in 'coins', with their total
+    value in gold, such as 'Coins: 350 sp, 20 gp; 55.00 gp'.'''
+    amounts = []
+    copper = 0
+    for coinage in COIN_TYPES:
+        if coinage in coins:
+            amounts.append('{0:,} {1}'.format(coins[coinage], coinage))
+            copper += coins[coinage] * item.COPPER_PER_COIN[coinage]
+    return 'Coins: ' + ', '.join(amounts) + '; ' + item.format_gp(copper)
+
+
+def iter_treasure(conn, requests, roller, listener,
+        limit=MAX_TREASURE_LOTS):
+    '''Yields the treasure for the requested lots of each treasure type, one
+    result at a time.  At most 'limit' lots of each type are generated, or
+    all of them if 'limit' is None.'''
     types = "abcdefghi"
-    accum = []
+    coins = {}
     for tt in types:
         if tt not in requests: continue
         # Get proper descriptions from the database.
         table = {}
         lookup_treasure_type(conn, tt, table)
         descriptions = table[tt]
-        # Stop at 100 items
-        remaining = 100
+        remaining = limit
         # Get the submitted counts.
         for item in requests[tt]:
             i = item['index']
             c = item['count']
-            c = min(remaining, c)
-            remaining -= c
+            if remaining is not None:
+                c = min(remaining, c)
+                remaining -= c
             descriptions[i]['count'] = c
             if c <= 0: break
-        treas = generate_treasure_type(conn, descriptions, roller, listener)
-        accum.extend(treas)
-    return accum
+        for result in iter_treasure_type(conn, descriptions, roller,
+                listener, coins):
+            yield result
+    # Then all of the coins, added up.
+    if coins:
+        yield format_coins(coins)
+
+
+def generate_treasure(conn, requests, roller, listener):
+    return list(iter_treasure(conn, requests, roller, listener))
+
+
+def fit_treasure(conn, budget, types):
+    '''Chooses how many lots of each row of the given treasure types to
+    generate, so that their costs add up to as close to 'budget' gp as
+    possible without going over (or nearly as close, for budgets too large
+    to fit exactly; see MAX_FIT_UNITS), favoring the costlier lots.  Returns
+    the counts, in the form generate_treasure takes, and their total
+    cost.'''
+    table = get_treasure_list(conn, types)
+    rows = []
+    for tt in types:
+        for row in table[tt]:
+            if 0 < row['cost'] <= budget:
+                rows.append((row['cost'], tt, row['index']))
+    if not rows:
+        return ({}, 0)
+
+    # Work in units of the costs' greatest common divisor, which keeps the
+    # number of totals small.  If there are still too many, use coarser
+    # units, rounding costs up, so the fit never goes over the budget.
+    unit = 0
+    for (cost, tt, index) in rows:
+        unit = gcd(unit, cost)
+    if budget // unit > MAX_FIT_UNITS:
+        unit = -(-budget // MAX_FIT_UNITS)
+    width = budget // unit
+    mask = (1 << (width + 1)) - 1
+
+    # Split each row's count into pieces of 1, 2, 4, ... lots, so that any
+    # count up to its bound is the sum of some of its pieces.  The costliest
+    # rows come first, so that a total is first made from them, and the fit
+    # takes few lots rather than hundreds of cheap ones.
+    pieces = []
+    for (cost, tt, index) in sorted(rows, key=lambda row: -row[0]):
+        bound = min(budget // cost, MAX_TREASURE_LOTS)
+        size = 1
+        while bound > 0:
+            n = min(size, bound)
+            pieces.append((-(-n * cost // unit), n, tt, index))
+            bound -= n
+            size *= 2
+
+    # Bit t of 'reachable' is set if a total of t units can be made from the
+    # pieces so far, and came_from[t] is the piece that first made it.  Each
+    # total is then made from a piece and a total made by earlier pieces.
+    reachable = 1
+    came_from = array.array('i', [-1]) * (width + 1)
+    for (i, piece) in enumerate(pieces):
+        new = (reachable << piece[0]) & mask & ~reachable
+        if not new:
+            continue
+        # Find the new totals in the binary digits, highest first.
+        digits = bin(new)
+        top = len(digits) - 1
+        j = digits.find('1', 2)
+        while j >= 0:
+            came_from[top - j] = i
+            j = digits.find('1', j + 1)
+        reachable |= new
+
+    # Walk back from the highest total reached, one piece at a time.
+    counts = {}
+    target = reachable.bit_length() - 1
+    total = 0
+    while target > 0:
+        (weight, n, tt, index) = pieces[came_from[target]]
+        target -= weight
+        counts[(tt, index)] = counts.get((tt, index), 0) + n
+    for (cost, tt, index) in rows:
+        total += cost * counts.get((tt, index), 0)
+
+    requests = {}
+    for (tt, index) in sorted(counts):
+        requests.setdefault(tt, []).append(
+                {'index': index, 'count': counts[(tt, index)]})
+    return (requests, total)
+
+
+def generate_fitted_treasure(conn, budget, types, roller, listener):
+    '''Fits lots of the given treasure types to the budget (see
+    fit_treasure), and generates them.'''
+    (requests, total) = fit_treasure(conn, budget, types)
+    # The fit already bounds the number of lots.
+    treasure = list(iter_treasure(conn, requests, roller, listener, None))
+    return {'budget': budget, 'total': total, 'counts': requests,
+            'treasure': treasure}
 
 #
 # Main Function
@@ -23,11 +23,14 @@ Generator.
 from __future__ import print_function
 
 import binascii
-import locale
-import math
+import bisect
+import hashlib
+import mmap
 import os
 import random
 import re
+import sqlite3 as sqlite
+import struct
 import sys
 
 #
@@ -36,18 +39,13 @@ import sys
 import rollers
 
 #
-# Module initialization
-
-if os.name == 'posix':
-    # An extremely recognizable locale string.
-    locale.setlocale(locale.LC_ALL, 'en_US')
-elif os.name == 'nt':
-    # Windows doesn't use the sensible value.
-    locale.setlocale(locale.LC_ALL, 'enu')
-else:
-    # My best guess for other OSes.
-    try: locale.setlocale(locale.LC_ALL, 'en_US')
-    except: pass
+# Compatibility
+
+# The type of text strings: unicode in Python 2, str in Python 3.
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
 
 # Constants
 
@@ -72,6 +70,9 @@ KEY_GEM           = 'Gem'
 
 ROLL_LEAST_MINOR = "Roll on the Least Minor table"
 
+# Every roll table is looked up with a d100.
+TABLE_DIE_SIDES = 100
+
 # Option values for specifying magic items parameters.
 
 # There is no official term for this, but I call them "degrees".
@@ -148,6 +149,29 @@ ITEM_SUBTYPE_MAP = {
         'gemstone'         : ('Gem', ''),
         }
 
+# Maps a main item type to the prefix of its tables in the frequency database
+# (see enumerate.py).
+FREQUENCY_PREFIXES = {
+        KEY_ARMOR         : 'armor',
+        KEY_WEAPON        : 'weapon',
+        KEY_POTION        : 'potion',
+        KEY_RING          : 'ring',
+        KEY_ROD           : 'rod',
+        KEY_SCROLL        : 'scroll',
+        KEY_STAFF         : 'staff',
+        KEY_WAND          : 'wand',
+        KEY_WONDROUS_ITEM : 'wondrous'
+        }
+
+# Table in the frequency database listing the item tables each enumerated
+# table was built from, with their hashes (see enumerate.py).  It holds no
+# items.
+FREQUENCY_SOURCES_TABLE = 'Enum_Sources'
+
+# Table in the standard database listing the data file each table was built
+# from, with its hash (see initdb.py).
+DATA_SOURCES_TABLE = 'Data_Sources'
+
 # Treasure expression
 
 # Sub-expressions that can be found in multiple treasure expressions.
@@ -177,24 +201,98 @@ MAP_NUMBER_WORD_DECIMAL = {
 RE_GEM_PRICE = re.compile(
     '([0-9,]+)\s+gp\s+(\+(\s*\d+d\d+)\s*((\xd7|\x78)([0-9,]+)\s*gp)?)?')
 
+# Prices
+
+# One amount of coins in a price string, such as '1,000 gp'.
+RE_PRICE_PIECE = re.compile('(((\d{1,3},)*\d+) *(pp|gp|sp|cp)?[, ]*)', re.I)
+
+# An enhancement bonus in place of a price, such as '+1 bonus'.
+RE_PRICE_BONUS = re.compile('\+(\d+) bonus')
+
+# Value of each coin, in copper pieces.  No coin type means gold.
+COPPER_PER_COIN = {'pp': 1000, 'gp': 100, 'sp': 10, 'cp': 1, None: 100}
+
+# Most parsed price strings to keep (see parse_price).
+MAX_CACHED_PRICES = 4096
+
+# Most compiled treasure expressions to keep (see compile_treasure_item).
+MAX_CACHED_TREASURE_PLANS = 1024
+
+# Most bytes of a database file to map into memory (see connect_read_only).
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Extension of the roll table snapshot written beside the standard database
+# (see TableSnapshot).
+SNAPSHOT_EXTENSION = '.tables'
+
+# Snapshot header: magic, format version, fingerprint of the database it was
+# taken from, number of tables, directory offset, number of strings, string
+# offsets offset, and string blob offset.
+SNAPSHOT_HEADER = struct.Struct('<4sI20sIIIII')
+SNAPSHOT_MAGIC = b'PFTS'
+# Version of what a snapshot holds: its layout, and the rows as compiled by
+# TableStore.compile_rows, with their prices as parse_price reads them.  Bump
+# it when any of those change, or older snapshots would still be used.
+SNAPSHOT_FORMAT_VERSION = 2
+
 
 #
 # Variables
 
-ENABLE_CACHE = False
-CACHE_TYPE = 0
-
 # Indicates that bad items will not be discarded.
 ENUMERATION_MODE = False
 
+# Cache of get_item_type_weights results, by strength.
+ITEM_TYPE_WEIGHTS = {}
+
+# Cache of parse_price results, by price string.
+PRICE_CACHE = {}
+
+# Cache of compile_treasure_item results, by treasure expression.
+TREASURE_PLANS = {}
+
 
 #
 # Functions
 
-def enable_caching(cache_type):
-    global ENABLE_CACHE, CACHE_TYPE
-    ENABLE_CACHE = True
-    CACHE_TYPE = cache_type
+def connect_read_only(filename):
+    '''Opens a database that nothing writes to while it is open.  It is
+    opened read-only and immutable, so SQLite takes no locks, and mapped into
+    memory, so every process reading it shares the same pages.  (Python 2
+    can't open SQLite URIs.  It opens the file normally, if it exists, and
+    refuses to change it.)'''
+    try:
+        conn = sqlite.connect('file:{0}?mode=ro&immutable=1'.format(
+            os.path.abspath(filename)), uri=True)
+    except TypeError:
+        # Opening a missing file would create it.
+        if not os.path.isfile(filename):
+            raise sqlite.OperationalError('unable to open database file')
+        conn = sqlite.connect(filename)
+        conn.execute('PRAGMA query_only = ON')
+    conn.row_factory = sqlite.Row
+    conn.execute('PRAGMA mmap_size = {0}'.format(MMAP_SIZE))
+    return conn
+
+
+def get_snapshot_filename(database):
+    '''Returns the name of the roll table snapshot of a standard database.'''
+    return os.path.splitext(database)[0] + SNAPSHOT_EXTENSION
+
+
+def get_data_fingerprint(conn):
+    '''Returns a digest of the data files that the tables of a standard
+    database were built from, or None if they aren't recorded.'''
+    try:
+        rows = conn.execute('SELECT Data_Table, Hash FROM {0} '
+                'ORDER BY Data_Table;'.format(DATA_SOURCES_TABLE)).fetchall()
+    except sqlite.Error:
+        return None
+    digest = hashlib.sha1()
+    for (table, table_hash) in rows:
+        digest.update('{0}\t{1}\n'.format(table, table_hash).encode('utf-8'))
+    return digest.digest()
+
 
 def set_enumeration():
     global ENUMERATION_MODE
@@ -211,6 +309,21 @@ def extract_keywords(sequence, keywords):
     return intersect
 
 
+def get_full_strength(strength, roll):
+    '''Qualifies a strength of minor, medium, or major with a degree, using a
+    d100 roll.'''
+    # We may decide to change this later, but at least for now, the choice
+    # between them will be 50/50.  Because slotless wondrous item can also
+    # be 'least minor', use least if the roll is less than 25.  Item types
+    # without the 'least' level will simply treat it as 'lesser'.
+    full_strength = 'greater '
+    if roll <= 25 and strength == 'minor':
+        full_strength = 'least '
+    elif roll <= 50:
+        full_strength = 'lesser '
+    return full_strength + strength
+
+
 def generate_generic(conn, strength, roller, base_value, **kwargs):
 
     listener = None
@@ -222,6 +335,26 @@ def generate_generic(conn, strength, roller, base_value, **kwargs):
     
     # This will account for specified and unspecified base values.
     min_value = float(base_value)
+
+    # With the enumerated tables at hand, draw straight from the items worth
+    # the base value, rather than rolling items until one is.  The draw is
+    # made with the random module, as a PseudorandomRoller's rolls are, so
+    # it is only made for one: other rollers, such as one asking the user
+    # for rolls, roll the items as usual.
+    freq_conn = kwargs.get('freq_conn')
+    if freq_conn is not None and min_value > 0 and \
+            isinstance(roller, rollers.PseudorandomRoller):
+        (x, acceptance) = generate_conditional(conn, freq_conn, strength,
+                min_value)
+        if acceptance is not None:
+            if x is None:
+                return InvalidItem('Error: no ' + strength + ' item is ' +
+                        'worth ' + str(base_value) + ' gp or more')
+            roller.start_item('Drew an item worth at least ' +
+                    str(base_value) + ' gp from the enumerated tables ' +
+                    '(acceptance probability {0:.6f})'.format(acceptance))
+            roller.finish_item()
+            return x
     value = 0.0
     x = None
     count = 0
@@ -230,17 +363,8 @@ def generate_generic(conn, strength, roller, base_value, **kwargs):
         # This is a potential new item
         roller.start_item('Rolling an item')
 
-        # We may decide to change this later, but at least for now, the choice
-        # between them will be 50/50.  Because slotless wondrous item can also
-        # be 'least minor', use least if the roll is less than 25.  Item types
-        # without the 'least' level will simply treat it as 'lesser'.
-        full_strength = 'greater '
         roll = roller.roll('1d100', 'degree')
-        if roll <= 25 and strength == 'minor':
-            full_strength = 'least '
-        elif roll <= 50:
-            full_strength = 'lesser '
-        full_strength += strength
+        full_strength = get_full_strength(strength, roll)
 
         # Now, select an item type.
         roll = roller.roll('1d100', 'item type')
@@ -263,6 +387,77 @@ def generate_generic(conn, strength, roller, base_value, **kwargs):
     return x
 
 
+def generate_conditional(conn, freq_conn, strength, base_value):
+    '''Draws an item from the enumerated tables, weighting degrees and item
+    types as generate_generic rolls them, conditioned on the item being worth
+    at least base_value.  Returns the item and the probability that an item
+    rolled by generate_generic is worth that much.  The item is None if that
+    probability is zero, and both are None if an enumerated table is
+    missing.'''
+    tables = []
+    weights = []
+    for (full_strength, p_degree) in get_roll_weights(
+            lambda roll: get_full_strength(strength, roll)):
+        for (kind, p_kind) in get_item_type_weights(conn, strength):
+            # Only wondrous items have a 'least' table.
+            if full_strength == 'least minor' and \
+                    ITEM_SUBTYPE_MAP[kind.lower()][0] != KEY_WONDROUS_ITEM:
+                table_strength = 'lesser minor'
+            else:
+                table_strength = full_strength
+            table = get_frequency_table(freq_conn, table_strength, kind)
+            if table is None:
+                return (None, None)
+            total = table.cumulative[-1]
+            if total <= 0:
+                continue
+            # The chance of this degree and type, times the chance its item
+            # is worth enough.
+            weight = p_degree * p_kind * table.weight_at_least(base_value) / \
+                    float(total)
+            if weight > 0:
+                tables.append(table)
+                weights.append(weight)
+    acceptance = sum(weights)
+    if acceptance <= 0:
+        return (None, 0.0)
+    # Pick a table by its weight, then an item from it.
+    roll = random.random() * acceptance
+    table = tables[-1]
+    for (candidate, weight) in zip(tables, weights):
+        if roll < weight:
+            table = candidate
+            break
+        roll -= weight
+    c = table.sample(base_value)
+    return (DatabaseItem(c['Subtype'], c['Item'], c['Price']), acceptance)
+
+
+def get_roll_weights(lookup):
+    '''Tallies the results of a function of a d100 roll, returning a list of
+    (result, probability) pairs, in order of first appearance.'''
+    counts = {}
+    order = []
+    for roll in range(1, TABLE_DIE_SIDES + 1):
+        result = lookup(roll)
+        if result not in counts:
+            counts[result] = 0
+            order.append(result)
+        counts[result] += 1
+    return [(result, counts[result] / float(TABLE_DIE_SIDES))
+            for result in order]
+
+
+def get_item_type_weights(conn, strength):
+    '''Returns (item type, probability) pairs for the item type roll made by
+    generate_generic, for minor, medium, or major.'''
+    if strength not in ITEM_TYPE_WEIGHTS:
+        ITEM_TYPE_WEIGHTS[strength] = [(kind, p) for (kind, p) in
+                get_roll_weights(lambda roll: get_item_type(conn, strength,
+                    roll)) if kind]
+    return ITEM_TYPE_WEIGHTS[strength]
+
+
 def generate_item(conn, description, roller, listener):
     # 'description' contains keywords.
     keywords = description.split(' ')
@@ -332,64 +527,63 @@ def fast_generate(conn, strength, base_value):
 
 def fast_generate_full(conn, strength, kind, base_value):
     # Quickly get an item from a table.
-    table = (kind + '_' + strength).replace(' ', '_').lower()
-
-    # Gather up the possible candidates.
-    # Note: Use the syntactic sugar offered by sqlite that uses a temporary
-    # cursor, otherwise, the results seem short by 1 row. Perhaps it has to do
-    # with using a cursor twice? Not quite sure.
-    # Anyway, just use the conn directly.
-
-    sql_a1 = 'SELECT SUM(Count) '
-    sql_a2 = 'SELECT * '
-    sql_b = 'FROM {0} WHERE Price >= (?);'.format(table)
-
+    table = get_frequency_table(conn, strength, kind)
+    if table is None:
+        return None
     try:
-        result_sum = conn.execute(sql_a1 + sql_b, (base_value,))
-        candidates = conn.execute(sql_a2 + sql_b, (base_value,))
+        c = table.sample(float(base_value))
+    except ValueError:
+        return None
+    if c is None:
+        return None
+    return DatabaseItem(c['Subtype'], c['Item'], c['Price'])
 
-        if candidates == None:
-            return None
 
-        # The number of items.
-        total = result_sum.fetchone()[0]
-
-        # Roll a random number in the total range.
-        roll = random.randrange(total)
-
-        # Go through the candidates until an item is found.
-        accum = 0
-        for c in candidates:
-            count = c['Count']
-            accum += count
-            if roll < accum:
-                return DatabaseItem(c['Subtype'], c['Item'], c['Price'])
-                #return '{0}: {1}; {2}'.format(c['Subtype'], c['Item'],
-                #        str(Price(c['Price'])) )
-        return None
-    except:
+def get_frequency_table(conn, strength, kind):
+    '''Returns the enumerated FrequencyTable for a strength and kind, or None
+    if the frequency database doesn't have one.'''
+    try:
+        prefix = FREQUENCY_PREFIXES[ITEM_SUBTYPE_MAP[kind.lower()][0]]
+    except KeyError:
         return None
+    table = (prefix + '_' + strength).replace(' ', '_').lower()
+    return FREQUENCY_STORE.get(conn, table)
 
 
 def generate_treasure_item(conn, expression, roller, listener):
-    results = []
+    return compile_treasure_item(expression).execute(conn, roller, listener)
+
+
+def compile_treasure_item(expression):
+    '''Returns a plan for one treasure expression, such as '2d4 x 100 cp' or
+    'two grade 3 gemstones', with its dice, counts and tables resolved, so it
+    can be generated any number of times without parsing it again.'''
+    try:
+        return TREASURE_PLANS[expression]
+    except KeyError:
+        pass
+    plan = parse_treasure_item(expression)
+    if len(TREASURE_PLANS) >= MAX_CACHED_TREASURE_PLANS:
+        TREASURE_PLANS.clear()
+    TREASURE_PLANS[expression] = plan
+    return plan
+
+
+def parse_treasure_item(expression):
     m = RE_TREASURE_COINS.match(expression)
     if m:
         # 1 is the dice expression
-        dice = m.group(1)
+        dice = rollers.compile_dice(m.group(1))
         # 2 is the entire multiplier expression
         # 3 is the multiplier symbol
         # 4 is the coin amount
         # 5 is the coin type
-        coefficient = rollers.rollDice(dice)
         multiplier = m.group(4)
         if multiplier == None:
             multiplier = 1
         else:
             multiplier = int(multiplier.replace(",",""))
-        coinage = m.group(5)
-        results.append(expression + ': ' + str(coefficient * multiplier) + ' ' + coinage)
-        return results
+        return TreasureCoins(expression, dice, multiplier, m.group(5))
 
     m = RE_TREASURE_PRETTIES.match(expression)
     if m:
@@ -401,10 +595,7 @@ def generate_treasure_item(conn, expression, roller, listener):
         count = MAP_NUMBER_WORD_DECIMAL[count]
         grade = 'grade ' + m.group(2)
         kind = m.group(3)
-        for i in range(count):
-            x = generate_specific_item(conn, grade, kind, roller, listener)
-            results.append(unicode(x))
-        return results
+        return TreasureBatch(grade, kind, count)
 
     m = RE_TREASURE_MAGIC.match(expression)
     if m:
@@ -414,64 +605,33 @@ def generate_treasure_item(conn, expression, roller, listener):
         degree = m.group(2)
         strength = m.group(3)
         kind = m.group(4)
-        for i in range(count):
-            x = generate_specific_item(conn, degree + ' ' + strength, kind, roller, listener)
-            results.append(unicode(x))
-        return results
+        return TreasureBatch(degree + ' ' + strength, kind, count)
 
     m = RE_TREASURE_MASTERWORK.match(expression)
     if m:
         kind = m.group(1).lower()
-        table = None
-        where = ''
-        where_vars = None
-        masterwork_fee = 0
         # TODO fix 'masterwork shield'
         if kind in 'light armor or shield':
-            table = TABLE_RANDOM_ARMOR_OR_SHIELD
-            where = 'WHERE (? == ?) OR (? == ?)'
-            where_vars = ('Subtype', 'light armor', 'Subtype', 'shield')
-            masterwork_fee = 150
+            return TreasureMasterwork(TABLE_RANDOM_ARMOR_OR_SHIELD,
+                    'WHERE (? == ?) OR (? == ?)',
+                    ('Subtype', 'light armor', 'Subtype', 'shield'), 150)
         elif kind == 'shield':
-            table = TABLE_RANDOM_ARMOR_OR_SHIELD
-            where = 'WHERE (? == ?)'
-            where_vars = ('Subtype', kind)
-            masterwork_fee = 150
+            return TreasureMasterwork(TABLE_RANDOM_ARMOR_OR_SHIELD,
+                    'WHERE (? == ?)', ('Subtype', kind), 150)
         elif kind == 'medium armor':
-            table = TABLE_RANDOM_ARMOR_OR_SHIELD
-            where = 'WHERE (? == ?)'
-            where_vars = ('Subtype', kind)
-            masterwork_fee = 150
+            return TreasureMasterwork(TABLE_RANDOM_ARMOR_OR_SHIELD,
+                    'WHERE (? == ?)', ('Subtype', kind), 150)
         elif kind == 'heavy armor':
-            table = TABLE_RANDOM_ARMOR_OR_SHIELD
-            where = 'WHERE (? == ?)'
-            where_vars = ('Subtype', kind)
-            masterwork_fee = 150
-        elif kind == 'weapon':
-            table = TABLE_RANDOM_WEAPON
-            where = ''
-            where_vars = None
-            masterwork_fee = 300
+            return TreasureMasterwork(TABLE_RANDOM_ARMOR_OR_SHIELD,
+                    'WHERE (? == ?)', ('Subtype', kind), 150)
         else:
-            #results.append('*** ' + kind + ' ***')
-            return
-
-        result = table.find_flat_custom(conn, where, where_vars)
-        if result:
-            item = result['Result']
-            price = Price(result['Price'])
-            price.add(masterwork_fee)
-            results.append('Masterwork ' + item + '; ' + str(price))
-
-        return results
-
-    if len(results) == 0:
-        # For regular usage.
-        results.append('Failed to generate for: ' + expression)
-        # For debugging:
-        #results.append("unknown: ("+expression+")[" + ':'.join([hex(ord(a)) for a in expression]) + "]")
+            # The expression only matches a weapon otherwise.
+            return TreasureMasterwork(TABLE_RANDOM_WEAPON, '', None, 300)
 
-    return results
+    # For regular usage.
+    return TreasureFailure('Failed to generate for: ' + expression)
+    # For debugging:
+    #return TreasureFailure("unknown: ("+expression+")[" + ':'.join([hex(ord(a)) for a in expression]) + "]")
 
 
 def create_item(kind):
@@ -578,6 +738,105 @@ def filter_specials(specials):
         del specials[k]
 
 
+def compile_rows(label, rows, problems):
+    '''Builds the dense roll array for a group of rows.  Slot i holds the
+    index of the row selected by a roll of i + 1, or -1 if no row covers it.
+    Returns the rows, the slots, and the branches: (index, number of rolls)
+    pairs for each distinct slot value.  If 'problems' is a list, gaps and
+    overlaps are appended to it.  Snapshots hold what this returns, so a
+    change to it needs a new SNAPSHOT_FORMAT_VERSION.'''
+    slots = [-1] * TABLE_DIE_SIDES
+    overlaps = []
+    for (index, row) in enumerate(rows):
+        low = max(int(row['Roll_low']), 1)
+        high = min(int(row['Roll_high']), TABLE_DIE_SIDES)
+        for roll in range(low, high + 1):
+            if slots[roll - 1] < 0:
+                slots[roll - 1] = index
+            else:
+                # The first row wins, as it would have with a query.
+                overlaps.append(roll)
+    if problems is not None:
+        gaps = [roll for roll in range(1, TABLE_DIE_SIDES + 1)
+                if slots[roll - 1] < 0]
+        if gaps:
+            problems.append('{0}: no row for rolls {1}'.format(label,
+                    roll_ranges_str(gaps)))
+        if overlaps:
+            problems.append('{0}: more than one row for rolls {1}'.format(
+                    label, roll_ranges_str(sorted(set(overlaps)))))
+    # List each row that any roll selects once, in roll order, with the
+    # number of rolls that select it.  Uncovered rolls form a branch of -1.
+    weights = {}
+    order = []
+    for index in slots:
+        if index not in weights:
+            weights[index] = 0
+            order.append(index)
+        weights[index] += 1
+    branches = tuple([(index, weights[index]) for index in order])
+    return (rows, tuple(slots), branches)
+
+
+def format_gp(copper):
+    '''Formats an amount of copper pieces as gold, with thousands separated
+    by commas, such as '1,000.50 gp'.  The process locale plays no part.'''
+    sign = ''
+    if copper < 0:
+        sign = '-'
+        copper = -copper
+    return '{0}{1:,}.{2:02d} gp'.format(sign, copper // 100, copper % 100)
+
+
+def parse_price(price_str):
+    '''Returns the (copper pieces, enhancement bonus) that a price string
+    adds to a Price.  Each distinct string is only parsed once.  Snapshots
+    hold what this returns, so a change to it needs a new
+    SNAPSHOT_FORMAT_VERSION.'''
+    try:
+        return PRICE_CACHE[price_str]
+    except KeyError:
+        pass
+    if price_str.endswith(' bonus'):
+        # The price depends on the total bonus, so it defers.
+        match = RE_PRICE_BONUS.match(price_str)
+        if not match:
+            raise BadPrice('cannot extract enhancement bonus from ' +
+                    price_str)
+        parsed = (0, int(match.group(1)))
+    else:
+        copper = 0
+        for piece in RE_PRICE_PIECE.finditer(price_str):
+            # Group 2 is the count, group 4 is the type.
+            coin_type = piece.group(4)
+            if coin_type:
+                coin_type = coin_type.lower()
+            copper += int(piece.group(2).replace(',', '')) * \
+                    COPPER_PER_COIN[coin_type]
+        parsed = (copper, 0)
+    cache_price(price_str, parsed)
+    return parsed
+
+
+def cache_price(price_str, parsed):
+    '''Remembers the parse_price result for a price string.'''
+    if len(PRICE_CACHE) >= MAX_CACHED_PRICES:
+        PRICE_CACHE.clear()
+    PRICE_CACHE[price_str] = parsed
+
+
+def roll_ranges_str(rolls):
+    '''Formats a sorted list of rolls as ranges, e.g. "1-3, 7".'''
+    spans = []
+    for roll in rolls:
+        if spans and spans[-1][1] == roll - 1:
+            spans[-1][1] = roll
+        else:
+            spans.append([roll, roll])
+    return ', '.join([str(a) if a == b else '{0}-{1}'.format(a, b)
+            for (a, b) in spans])
+
+
 
 #
 # Classes
@@ -591,140 +850,560 @@ class BadPrice(Exception):
 
 
 class Price(object):
+    '''A price, kept in whole copper pieces, plus an enhancement bonus whose
+    cost depends on its total.'''
+
+    __slots__ = ('enhancement_type', 'copper', 'enhancement', 'invalid',
+            'text')
 
     def __init__(self, initial_value, enhancement_type=''):
         self.enhancement_type = enhancement_type
-        self.gold = 0.0
+        self.copper = 0
         self.enhancement = 0
-        self.piece_expr = re.compile('(((\d{1,3},)*\d+) *(pp|gp|sp|cp)?[, ]*)', re.I)
+        # Set when the price could not be determined.
+        self.invalid = False
+        # The formatted price, made when first needed.
+        self.text = None
         # Initialize with the provided string
         self.add(initial_value)
 
 
     def __lt__(self, other):
-        return self.gold < other.gold
+        return self.as_copper() < other.as_copper()
 
 
     def __le__(self, other):
-        return self.gold <= other.gold
+        return self.as_copper() <= other.as_copper()
 
 
     def __str__(self):
-        f = self.as_float()
-        if math.isnan(f):
-            return '<error> gp'
-        return locale.format_string('%.2f', f, grouping=True) + ' gp'
+        if self.text is None:
+            if self.invalid:
+                self.text = '<error> gp'
+            else:
+                self.text = format_gp(self.as_copper())
+        return self.text
 
-    def as_float(self):
-        cost = self.gold
+    def as_copper(self):
+        cost = self.copper
         if self.enhancement > 0:
-             temp = (self.enhancement ** 2) * 1000
+             temp = (self.enhancement ** 2) * 100000
              if self.enhancement_type == 'weapon':
                  temp *= 2
              cost += temp
         return cost
 
+    def as_float(self):
+        if self.invalid:
+            return float('nan')
+        return self.as_copper() / 100.0
+
     def add(self, price_piece):
-        # If the value provided is int or float, add it directly.
+        self.text = None
+        # If the value provided is int or float, it is in gold.
         if type(price_piece) == int or type(price_piece) == float:
-            self.gold += float(price_piece)
-        # If it's a bonus, the price depends on the sum, so it defers.
-        elif price_piece.endswith(' bonus'):
-            self.add_enhancement(price_piece)
+            self.copper += int(round(price_piece * 100))
         # Empty string is non-value.
         elif price_piece == None or price_piece == '':
-            self.gold = float('nan')
-        # Otherwise, it might be a pp/gp/sp/cp string.
+            self.invalid = True
+        # Otherwise, it might be a pp/gp/sp/cp string, or a bonus.
         else:
-            self.add_expression(price_piece)
+            (copper, enhancement) = parse_price(price_piece)
+            self.copper += copper
+            self.enhancement += enhancement
 
     def multiply(self, factor):
-        self.gold *= (float(factor))
+        self.text = None
+        self.copper = int(round(self.copper * float(factor)))
 
     def add_expression(self, expr):
-        for piece in self.piece_expr.finditer(expr):
-            # Group 2 is the count, group 4 is the type.
-            scale = 0.0
-            count = float(piece.group(2).replace(',',''))
-            coin_type = piece.group(4)
-            if   coin_type == 'pp': scale = 10.00
-            elif coin_type == 'gp': scale =  1.00
-            elif coin_type == 'sp': scale =  0.10
-            elif coin_type == 'cp': scale =  0.01
-            elif coin_type == None: scale =  1.00
-            self.gold += (count * scale)
+        self.text = None
+        self.copper += parse_price(expr)[0]
 
 
     def add_enhancement(self, price_str):
+        self.text = None
         if type(price_str) == int:
             self.enhancement += price_str
             return
-        match = re.match('\+(\d+) bonus', price_str)
+        match = RE_PRICE_BONUS.match(price_str)
         if match:
             self.enhancement += int(match.group(1))
         else:
             raise BadPrice('cannot extract enhancement bonus from ' +
                     price_str)
- 
+
+
+class SnapshotRow(object):
+    '''A row read from a roll table snapshot, which can be used like the
+    sqlite3.Row it was taken from.'''
+
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns, values):
+        # Maps a column name to its index, shared by the rows of a table.
+        self.columns = columns
+        self.values = values
+
+
+    def __getitem__(self, key):
+        if key in self.columns:
+            return self.values[self.columns[key]]
+        if isinstance(key, int):
+            return self.values[key]
+        raise IndexError('No item with that key')
+
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def keys(self):
+        return sorted(self.columns, key=self.columns.get)
+
+
+class TableSnapshot(object):
+    '''The compiled roll tables, as a file that is mapped into memory rather
+    than read, so a process only decodes the tables it rolls on.  initdb.py
+    writes it beside the standard database (see TableStore.dump_snapshot).
+
+    After the header and a directory of (name, offset) pairs for the tables,
+    each table holds its column names, its cells, the precomputed prices of
+    its price strings, and its compiled groups of rows, each with its roll
+    array and branches, all fixed width.  Every string is an index into one
+    blob of UTF-8 text, and is decoded at most once.'''
+
+    def __init__(self, mapped, fingerprint):
+        (magic, version, snapshot_fingerprint, table_count, directory,
+                string_count, self.string_offsets, self.blob) = \
+                        SNAPSHOT_HEADER.unpack_from(mapped, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError('not a roll table snapshot')
+        if snapshot_fingerprint != fingerprint:
+            raise ValueError('snapshot of another database')
+        self.mapped = mapped
+        # Decoded strings, by index.
+        self.strings = {}
+        # Maps a table name to the offset of the table.
+        self.tables = {}
+        for i in range(table_count):
+            (name, offset) = struct.unpack_from('<II', mapped,
+                    directory + 8 * i)
+            self.tables[self.get_string(name)] = offset
+
+
+    def close(self):
+        self.mapped.close()
+
+
+    def get_string(self, index):
+        try:
+            return self.strings[index]
+        except KeyError:
+            pass
+        (start, end) = struct.unpack_from('<II', self.mapped,
+                self.string_offsets + 4 * index)
+        text = self.mapped[self.blob + start:self.blob + end].decode('utf-8')
+        self.strings[index] = text
+        return text
+
+
+    def get_value(self, cell):
+        # Integers are shifted left a bit, and strings are their index,
+        # shifted left a bit with the low bit set; -1 is NULL.
+        if cell & 1 == 0:
+            return cell >> 1
+        if cell < 0:
+            return None
+        return self.get_string(cell >> 1)
+
+
+    def read_table(self, name):
+        '''Returns a table in the form of TableStore.tables, and remembers
+        the prices of its price strings.'''
+        mapped = self.mapped
+        offset = self.tables[name]
+        (column_count, row_count, price_count, group_count) = \
+                struct.unpack_from('<IIII', mapped, offset)
+        offset += 16
+        names = struct.unpack_from('<{0}I'.format(column_count), mapped,
+                offset)
+        offset += 4 * column_count
+        columns = dict((self.get_string(index), column)
+                for (column, index) in enumerate(names))
+        cells = struct.unpack_from('<{0}q'.format(row_count * column_count),
+                mapped, offset)
+        offset += 8 * row_count * column_count
+        values = [self.get_value(cell) for cell in cells]
+        rows = tuple([SnapshotRow(columns,
+            tuple(values[i:i + column_count]))
+            for i in range(0, row_count * column_count, column_count)])
+        for i in range(price_count):
+            (index, copper, enhancement) = struct.unpack_from('<Iqi', mapped,
+                    offset)
+            offset += 16
+            price_str = self.get_string(index)
+            if price_str not in PRICE_CACHE:
+                cache_price(price_str, (copper, enhancement))
+        compiled = {}
+        for i in range(group_count):
+            (strength, member_count, slot_count, branch_count) = \
+                    struct.unpack_from('<iIII', mapped, offset)
+            offset += 16
+            members = struct.unpack_from('<{0}I'.format(member_count),
+                    mapped, offset)
+            offset += 4 * member_count
+            slots = struct.unpack_from('<{0}h'.format(slot_count), mapped,
+                    offset)
+            offset += 2 * slot_count
+            pairs = struct.unpack_from('<{0}h'.format(2 * branch_count),
+                    mapped, offset)
+            offset += 4 * branch_count
+            branches = tuple(zip(pairs[0::2], pairs[1::2]))
+            if strength >= 0:
+                strength = self.get_string(strength)
+            else:
+                strength = None
+            compiled[strength] = (tuple([rows[m] for m in members]), slots,
+                    branches)
+        return compiled
+
+
+class TableStore(object):
+    '''Holds the rows of every registered roll table in memory, so that rolls
+    can be resolved without going back to the database.  All of the tables are
+    read together, once per process, the first time any of them is needed.
+
+    Each group of rows (per strength) is compiled into a dense array with one
+    slot per face of the d100, holding the index of the row that roll selects,
+    so a lookup is a single index.  Coverage gaps and overlapping ranges found
+    while compiling are collected in 'problems'.
+
+    If the database has an up to date snapshot beside it (see TableSnapshot),
+    the tables are instead taken from it one at a time, as they are needed.'''
+
+    def __init__(self):
+        # Names of the tables to load, in order of registration.
+        self.names = []
+        # Maps a table name to a dict of strength to the (rows, slots,
+        # branches) built by compile_rows.
+        # The None strength holds every row of the table.
+        self.tables = None
+        # Descriptions of gaps and overlaps found in the tables.
+        self.problems = []
+        # The TableSnapshot the tables are read from, if any.
+        self.snapshot = None
+
+
+    def register(self, name):
+        self.names.append(name)
+
+
+    def is_loaded(self):
+        return self.tables is not None
+
+
+    def load(self, conn):
+        tables = {}
+        problems = []
+        for name in self.names:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite.Row
+            cursor.execute('SELECT * FROM {0};'.format(name))
+            columns = [d[0] for d in cursor.description]
+            rows = tuple(cursor.fetchall())
+            # Group the rows by strength, keeping the table order, which is
+            # the order the database would have searched them in.
+            groups = {}
+            if 'Strength' in columns:
+                for row in rows:
+                    groups.setdefault(row['Strength'], []).append(row)
+            compiled = {}
+            for (strength, group) in groups.items():
+                label = '{0} ({1})'.format(name, strength)
+                compiled[strength] = compile_rows(label, tuple(group),
+                        problems)
+            # The whole table is only checked when there are no strengths,
+            # since otherwise the strengths overlap each other by design.
+            if len(groups) == 0:
+                compiled[None] = compile_rows(name, rows, problems)
+            else:
+                compiled[None] = compile_rows(name, rows, None)
+            tables[name] = compiled
+        self.close_snapshot()
+        self.tables = tables
+        self.problems = problems
+
+
+    def open_snapshot(self, conn):
+        '''Maps the snapshot beside the database that 'conn' reads, if it was
+        taken from that database.  Returns whether it was.'''
+        database = None
+        for row in conn.execute('PRAGMA database_list;'):
+            if row[1] == 'main':
+                database = row[2]
+        if not database:
+            return False
+        filename = get_snapshot_filename(database)
+        if not os.path.isfile(filename):
+            return False
+        fingerprint = get_data_fingerprint(conn)
+        if fingerprint is None:
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return False
+        try:
+            snapshot = TableSnapshot(mapped, fingerprint)
+        except (ValueError, struct.error):
+            mapped.close()
+            return False
+        self.close_snapshot()
+        self.snapshot = snapshot
+        self.tables = {}
+        self.problems = []
+        return True
+
+
+    def close_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+
+    def dump_snapshot(self, fingerprint):
+        '''Returns the loaded tables as the contents of a snapshot file, for
+        the database with the given fingerprint.'''
+        strings = []
+        string_ids = {}
+        def intern(text):
+            if text not in string_ids:
+                string_ids[text] = len(strings)
+                strings.append(text.encode('utf-8'))
+            return string_ids[text]
+        def encode(value):
+            if value is None:
+                return -1
+            if isinstance(value, int):
+                return value << 1
+            return (intern(value) << 1) | 1
+
+        directory = []
+        records = []
+        size = 0
+        for name in self.names:
+            compiled = self.tables[name]
+            rows = compiled[None][0]
+            columns = list(rows[0].keys()) if rows else []
+            cells = [encode(row[column]) for row in rows
+                    for column in columns]
+            # Parse the prices now, rather than in every process.
+            prices = []
+            if 'Price' in columns:
+                for price_str in sorted(set([row['Price'] for row in rows])):
+                    try:
+                        (copper, enhancement) = parse_price(price_str)
+                    except (BadPrice, AttributeError):
+                        continue
+                    prices.append(struct.pack('<Iqi', intern(price_str),
+                        copper, enhancement))
+            record = [struct.pack('<IIII', len(columns), len(rows),
+                len(prices), len(compiled))]
+            record.append(struct.pack('<{0}I'.format(len(columns)),
+                *[intern(column) for column in columns]))
+            record.append(struct.pack('<{0}q'.format(len(cells)), *cells))
+            record.extend(prices)
+            # The groups refer to the table's rows by index.
+            indexes = dict((id(row), i) for (i, row) in enumerate(rows))
+            for strength in sorted(compiled, key=lambda x: (x is not None, x)):
+                (members, slots, branches) = compiled[strength]
+                record.append(struct.pack('<iIII',
+                    -1 if strength is None else intern(strength),
+                    len(members), len(slots), len(branches)))
+                record.append(struct.pack('<{0}I'.format(len(members)),
+                    *[indexes[id(row)] for row in members]))
+                record.append(struct.pack('<{0}h'.format(len(slots)),
+                    *slots))
+                record.append(struct.pack('<{0}h'.format(2 * len(branches)),
+                    *[n for branch in branches for n in branch]))
+            record = b''.join(record)
+            directory.append((intern(name), size))
+            records.append(record)
+            size += len(record)
+
+        # Lay out the header, the directory, the tables, and the strings.
+        start = SNAPSHOT_HEADER.size + 8 * len(directory)
+        string_offsets = start + size
+        blob = string_offsets + 4 * (len(strings) + 1)
+        offsets = [0]
+        for text in strings:
+            offsets.append(offsets[-1] + len(text))
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION,
+            fingerprint, len(directory), SNAPSHOT_HEADER.size,
+            len(strings), string_offsets, blob)]
+        parts.extend([struct.pack('<II', name, start + offset)
+            for (name, offset) in directory])
+        parts.extend(records)
+        parts.append(struct.pack('<{0}I'.format(len(offsets)), *offsets))
+        parts.extend(strings)
+        return b''.join(parts)
+
+
+    def clear(self):
+        self.close_snapshot()
+        self.tables = None
+        self.problems = []
+
+
+    def get(self, conn, name):
+        if self.tables is None:
+            if not self.open_snapshot(conn):
+                self.load(conn)
+        try:
+            return self.tables[name]
+        except KeyError:
+            if self.snapshot is None:
+                raise
+        compiled = self.snapshot.read_table(name)
+        self.tables[name] = compiled
+        return compiled
+
+
+# The one store shared by all Table objects.
+TABLE_STORE = TableStore()
+
+# Stands in for a strength that a table does not have.
+EMPTY_ROWS = ((), (), ())
+
+
+class FrequencyTable(object):
+    '''The rows of one enumerated item table from the frequency database,
+    sorted by price.  An alias table, built the first time it is needed,
+    draws from all of the rows in constant time, and running totals of Count
+    let a draw restricted to the rows priced at or above some value be made
+    with a bisection.'''
+
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda row: row['Price'])
+        self.prices = [row['Price'] for row in self.rows]
+        # cumulative[i] is the total Count of the i cheapest rows, so the
+        # total Count of rows i and up is cumulative[-1] - cumulative[i].
+        self.cumulative = [0]
+        for row in self.rows:
+            self.cumulative.append(self.cumulative[-1] + row['Count'])
+        self.alias = None
+
+
+    def weight_at_least(self, base_value):
+        '''Returns the total Count of the rows priced at or above base_value.'''
+        i = bisect.bisect_left(self.prices, base_value)
+        return self.cumulative[-1] - self.cumulative[i]
+
+
+    def sample(self, base_value):
+        '''Draws a row priced at or above base_value, or returns None if there
+        are none.'''
+        i = bisect.bisect_left(self.prices, base_value)
+        start = self.cumulative[i]
+        if start >= self.cumulative[-1]:
+            return None
+        # When every row qualifies, the alias table draws in constant time.
+        if i == 0:
+            if self.alias is None:
+                self.alias = rollers.AliasTable([row['Count']
+                    for row in self.rows])
+            return self.rows[self.alias.sample()]
+        # Pick a point in the qualifying rows' share of the running total.
+        roll = random.randrange(start, self.cumulative[-1])
+        return self.rows[bisect.bisect_right(self.cumulative, roll) - 1]
+
+
+class FrequencyStore(object):
+    '''Holds the enumerated item tables from the frequency database in
+    memory.  Each is read the first time it is needed, and kept for the life
+    of the process.'''
+
+    def __init__(self):
+        # Maps a table name to a FrequencyTable, or None if there is no such
+        # table.
+        self.tables = {}
+        # Whether every table has been read (see load).
+        self.loaded = False
+
+
+    def is_loaded(self):
+        return self.loaded
+
+
+    def load(self, conn):
+        '''Reads every table, for a process that will serve many requests.'''
+        names = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table';")]
+        for name in names:
+            if name != FREQUENCY_SOURCES_TABLE:
+                self.get(conn, name)
+        self.loaded = True
+
+
+    def read_table(self, conn, name):
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite.Row
+        try:
+            cursor.execute('SELECT * FROM {0};'.format(name))
+        except sqlite.OperationalError:
+            # No such table.
+            return None
+        return FrequencyTable(tuple(cursor.fetchall()))
+
+
+    def clear(self):
+        self.tables = {}
+        self.loaded = False
+
+
+    def get(self, conn, name):
+        try:
+            return self.tables[name]
+        except KeyError:
+            pass
+        table = self.read_table(conn, name)
+        self.tables[name] = table
+        return table
+
+
+# The one store of frequency tables.
+FREQUENCY_STORE = FrequencyStore()
+
 
 class Table(object):
 
     def __init__(self, table):
         self.table = table
-        self.cache = {}
-        self.cache_style = CACHE_TYPE
-        self.query_nostrength = '''SELECT * FROM {0} WHERE (? >= Roll_low) AND
-            (? <= Roll_high);'''.format(self.table)
-        self.query_strength = '''SELECT * FROM {0} WHERE (? >= Roll_low) AND
-            (? <= Roll_high) AND (? = Strength);'''.format(self.table)
-        
+        TABLE_STORE.register(table)
+
 
     def find_roll(self, conn, roll, strength, purpose, listener):
-        # If caching is enabled, go for it
-        if ENABLE_CACHE:
-            if self.cache_style == 1:
-                if strength not in self.cache:
-                    self.cache[strength] = []
-                for line in self.cache[strength]:
-                    if roll >= line['low'] and roll <= line['high']:
-                        return line['result']
-            elif self.cache_style == 2:
-                if strength not in self.cache:
-                    self.cache[strength] = {}
-                if strength in self.cache:
-                    a = self.cache[strength]
-                    if roll in a:
-                        return a[roll]
-        
-        cursor = conn.cursor()
-        if strength == None:
-            cursor.execute(self.query_nostrength, (roll, roll))
-        else:
-            cursor.execute(self.query_strength, (roll, roll, strength))
-        result = cursor.fetchone()
-        if result:
-            try:
-                if listener:
-                    low = result['Roll_low']
-                    high = result['Roll_high']
-                    listener.item_rolled(purpose, low, high, strength)
-            except IndexError as ex:
-                return None
+        (rows, slots, branches) = TABLE_STORE.get(conn, self.table).get(
+                strength, EMPTY_ROWS)
+        if listener:
+            # Enumerating: the listener picks which of the rows to follow,
+            # and the roll itself is ignored.
+            index = listener.choose_branch(self.table, purpose, branches)
+        elif roll < 1 or roll > len(slots):
+            return None
         else:
+            # Index straight into the compiled roll array.
+            index = slots[roll - 1]
+        if index < 0:
             #print('No result for roll', roll)
             return None
-
-        if ENABLE_CACHE:
-            if self.cache_style == 1:
-                line = {}
-                line['low'] = result['Roll_low']
-                line['high'] = result['Roll_high']
-                line['result'] = result
-                self.cache[strength].append(line)
-            elif self.cache_style == 2:
-                for i in range(int(result['Roll_low']), int(result['Roll_high']) + 1):
-                    self.cache[strength][i] = result
-        return result
+        return rows[index]
 
     def find_flat_custom(self, conn, where, where_vars):
         sql = 'SELECT * FROM {0} '.format(self.table) + where
@@ -828,6 +1507,123 @@ TABLE_WONDROUS_ITEMS_SLOTLESS         = Table('Wondrous_Items_Slotless')
 TABLE_WONDROUS_ITEMS_WRISTS           = Table('Wondrous_Items_Wrists')
 
 
+class TreasureCoins(object):
+    '''A compiled treasure expression for a roll of coins.'''
+
+    __slots__ = ('expression', 'dice', 'multiplier', 'coinage')
+
+    def __init__(self, expression, dice, multiplier, coinage):
+        self.expression = expression
+        self.dice = dice
+        self.multiplier = multiplier
+        self.coinage = coinage
+
+
+    def execute(self, conn, roller, listener):
+        amount = self.dice.roll() * self.multiplier
+        return [self.expression + ': ' + '{0:,}'.format(amount) + ' ' +
+                self.coinage]
+
+
+    # Roll the coins for 'count' lots at once, returning the number of coins.
+    def roll_many(self, count):
+        return sum(self.dice.roll_many(count)) * self.multiplier
+
+
+class TreasureBatch(object):
+    '''A compiled treasure expression for some number of items of one
+    strength and kind, such as gems, art objects, or magic items.'''
+
+    __slots__ = ('strength', 'kind', 'count')
+
+    def __init__(self, strength, kind, count):
+        self.strength = strength
+        self.kind = kind
+        self.count = count
+
+
+    def execute(self, conn, roller, listener):
+        return [text_type(generate_specific_item(conn, self.strength,
+            self.kind, roller, listener)) for i in range(self.count)]
+
+
+class TreasureMasterwork(object):
+    '''A compiled treasure expression for a masterwork armor, shield, or
+    weapon.'''
+
+    __slots__ = ('table', 'where', 'where_vars', 'masterwork_fee')
+
+    def __init__(self, table, where, where_vars, masterwork_fee):
+        self.table = table
+        self.where = where
+        self.where_vars = where_vars
+        self.masterwork_fee = masterwork_fee
+
+
+    def execute(self, conn, roller, listener):
+        results = []
+        result = self.table.find_flat_custom(conn, self.where, self.where_vars)
+        if result:
+            item = result['Result']
+            price = Price(result['Price'])
+            price.add(self.masterwork_fee)
+            results.append('Masterwork ' + item + '; ' + str(price))
+        return results
+
+
+class TreasureFailure(object):
+    '''A treasure expression that could not be understood.'''
+
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+
+    def execute(self, conn, roller, listener):
+        return [self.message]
+
+
+class ItemRecord(object):
+    '''A finished item: just what is shown for it, without the generation
+    state an Item carries.  Many of these can be kept at once.'''
+
+    __slots__ = ('kind', 'subtype', 'label', 'price', 'bad_item')
+
+    def __init__(self, kind, subtype, label, price, bad_item=False):
+        self.kind = kind
+        self.subtype = subtype
+        self.label = label
+        self.price = price
+        # Validity flag, copied from the Item (used in enumeration mode)
+        self.bad_item = bad_item
+
+
+    # The standard __str__ method, matching Item's
+    def __str__(self):
+        # If the subtype is already in the name, skip it.
+        if self.label.startswith(self.subtype):
+            s = self.label
+        else:
+            s = self.subtype + ': ' + self.label
+        if self.bad_item:
+            s += " [invalid]"
+        return s
+
+
+    # Return a dictionary describing the item.
+    def get_dict(self):
+        return {
+                'item' : text_type(self),
+                'value_num' : self.price.as_float() if self.price is not None else 0,
+                'value_str' : str(self.price if self.price is not None else '')
+                }
+
+
+    def is_bad(self):
+        return self.bad_item
+
+
 class Item(object):
 
     #
@@ -881,7 +1677,7 @@ class Item(object):
     # Return a dictionary describing the item.
     def get_dict(self):
         return {
-                'item' : unicode(self),
+                'item' : text_type(self),
                 'value_num' : self.price.as_float() if self.price is not None else 0,
                 'value_str' : str(self.price if self.price is not None else '')
                 }
@@ -895,6 +1691,12 @@ class Item(object):
         return self.bad_item
 
 
+    # Returns the finished item as an ItemRecord.
+    def to_record(self):
+        return ItemRecord(self.kind, self.subtype, self.label, self.price,
+                self.bad_item)
+
+
     #
     # Consider these "private"
 
@@ -933,28 +1735,29 @@ class InvalidItem(Item):
         self.subtype = ''
 
 
-class DatabaseItem(Item):
+class DatabaseItem(ItemRecord):
+
+    __slots__ = ()
 
     def __init__(self, subtype, item, price):
-        Item.__init__(self, KEY_DATABASE)
-        self.subtype = subtype
-        self.label = item
-        self.price = Price(price)
+        ItemRecord.__init__(self, KEY_DATABASE, subtype, item, Price(price))
 
 
 class Armor(Item):
 
+    # Tables, shared by every instance.
+    t_random          = TABLE_RANDOM_ARMOR_OR_SHIELD
+    t_magic           = TABLE_MAGIC_ARMOR_AND_SHIELDS
+    t_specific_armor  = TABLE_SPECIFIC_ARMOR
+    t_specials_armor  = TABLE_SPECIAL_ABILITIES_ARMOR
+    t_specific_shield = TABLE_SPECIFIC_SHIELDS
+    t_specials_shield = TABLE_SPECIAL_ABILITIES_SHIELD
+    re_enhancement = re.compile('\+(\d+) armor or shield')
+    re_specials = re.compile('with (\w+) \+(\d+) special')
+
+
     def __init__(self):
         Item.__init__(self, KEY_ARMOR)
-        # Load tables
-        self.t_random          = TABLE_RANDOM_ARMOR_OR_SHIELD
-        self.t_magic           = TABLE_MAGIC_ARMOR_AND_SHIELDS
-        self.t_specific_armor  = TABLE_SPECIFIC_ARMOR
-        self.t_specials_armor  = TABLE_SPECIAL_ABILITIES_ARMOR
-        self.t_specific_shield = TABLE_SPECIFIC_SHIELDS
-        self.t_specials_shield = TABLE_SPECIAL_ABILITIES_SHIELD
-        self.re_enhancement = re.compile('\+(\d+) armor or shield')
-        self.re_specials = re.compile('with (\w+) \+(\d+) special')
         # Armor details
         # Generic item or specific
         self.is_generic = True
@@ -1110,19 +1913,21 @@ class Armor(Item):
 
 class Weapon(Item):
 
+    # Tables, shared by every instance.
+    t_random          = TABLE_RANDOM_WEAPON
+    t_magic           = TABLE_MAGIC_WEAPONS
+    t_specific_weapon = TABLE_SPECIFIC_WEAPONS
+    t_specials_melee  = TABLE_SPECIAL_ABILITIES_MELEE_WEAPON
+    t_specials_ranged = TABLE_SPECIAL_ABILITIES_RANGED_WEAPON
+    re_enhancement = re.compile('\+(\d+) weapon')
+    # Expression for:
+    # with one +X special ability
+    # with two +X special abilities
+    re_specials = re.compile(' (\w+) \+(\d+) special')
+
+
     def __init__(self):
         Item.__init__(self, KEY_ARMOR)
-        # Load tables
-        self.t_random          = TABLE_RANDOM_WEAPON
-        self.t_magic           = TABLE_MAGIC_WEAPONS
-        self.t_specific_weapon = TABLE_SPECIFIC_WEAPONS
-        self.t_specials_melee  = TABLE_SPECIAL_ABILITIES_MELEE_WEAPON
-        self.t_specials_ranged = TABLE_SPECIAL_ABILITIES_RANGED_WEAPON
-        self.re_enhancement = re.compile('\+(\d+) weapon')
-        # Expression for:
-        # with one +X special ability
-        # with two +X special abilities
-        self.re_specials = re.compile(' (\w+) \+(\d+) special')
         # Weapon details
         # Generic item or specific
         self.is_generic = True
@@ -1313,15 +2118,20 @@ class Weapon(Item):
 
 class Potion(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_RANDOM_POTIONS_AND_OILS
+    t_type = TABLE_POTION_OR_OIL_TYPE
+    # Spell tables, by spell level.
+    t_potions = {
+            '0' : TABLE_POTION_OR_OIL_LEVEL_0,
+            '1st' : TABLE_POTION_OR_OIL_LEVEL_1,
+            '2nd' : TABLE_POTION_OR_OIL_LEVEL_2,
+            '3rd' : TABLE_POTION_OR_OIL_LEVEL_3
+            }
+
+
     def __init__(self):
         Item.__init__(self, KEY_POTION)
-        # Load tables.
-        self.t_random = TABLE_RANDOM_POTIONS_AND_OILS
-        self.t_type = TABLE_POTION_OR_OIL_TYPE
-        self.t_potions_0 = TABLE_POTION_OR_OIL_LEVEL_0
-        self.t_potions_1 = TABLE_POTION_OR_OIL_LEVEL_1
-        self.t_potions_2 = TABLE_POTION_OR_OIL_LEVEL_2
-        self.t_potions_3 = TABLE_POTION_OR_OIL_LEVEL_3
         # Potion details
         self.spell = ''
         self.spell_level = ''
@@ -1357,14 +2167,9 @@ class Potion(Item):
         result = None
         purpose = 'potion spell'
         roll = self.roll('1d100', purpose)
-        if self.spell_level == '0':
-            result = self.t_potions_0.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '1st':
-            result = self.t_potions_1.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '2nd':
-            result = self.t_potions_2.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '3rd':
-            result = self.t_potions_3.find_roll(conn, roll, commonness, purpose, listener)
+        table = self.t_potions.get(self.spell_level)
+        if table:
+            result = table.find_roll(conn, roll, commonness, purpose, listener)
         self.spell = result['Result']
         self.price = result['Price']
 
@@ -1381,10 +2186,12 @@ class Potion(Item):
 
 class Ring(Item):
 
+    # Tables, shared by every instance.
+    t_rings = TABLE_RINGS
+
+
     def __init__(self):
         Item.__init__(self, KEY_RING)
-        # Load tables.
-        self.t_rings = TABLE_RINGS
         # Ring details.
         self.ring = ''
         self.price = ''
@@ -1416,10 +2223,12 @@ class Ring(Item):
 
 class Rod(Item):
 
+    # Tables, shared by every instance.
+    t_rods = TABLE_RODS
+
+
     def __init__(self):
         Item.__init__(self, KEY_ROD)
-        # Load tables.
-        self.t_rods = TABLE_RODS
 
 
     def __repr__(self):
@@ -1448,31 +2257,38 @@ class Rod(Item):
 
 class Scroll(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_RANDOM_SCROLLS
+    t_type = TABLE_SCROLL_TYPE
+    # Spell tables, by spell level.
+    t_arcane = {
+            '0' : TABLE_SCROLLS_ARCANE_LEVEL_0,
+            '1st' : TABLE_SCROLLS_ARCANE_LEVEL_1,
+            '2nd' : TABLE_SCROLLS_ARCANE_LEVEL_2,
+            '3rd' : TABLE_SCROLLS_ARCANE_LEVEL_3,
+            '4th' : TABLE_SCROLLS_ARCANE_LEVEL_4,
+            '5th' : TABLE_SCROLLS_ARCANE_LEVEL_5,
+            '6th' : TABLE_SCROLLS_ARCANE_LEVEL_6,
+            '7th' : TABLE_SCROLLS_ARCANE_LEVEL_7,
+            '8th' : TABLE_SCROLLS_ARCANE_LEVEL_8,
+            '9th' : TABLE_SCROLLS_ARCANE_LEVEL_9
+            }
+    t_divine = {
+            '0' : TABLE_SCROLLS_DIVINE_LEVEL_0,
+            '1st' : TABLE_SCROLLS_DIVINE_LEVEL_1,
+            '2nd' : TABLE_SCROLLS_DIVINE_LEVEL_2,
+            '3rd' : TABLE_SCROLLS_DIVINE_LEVEL_3,
+            '4th' : TABLE_SCROLLS_DIVINE_LEVEL_4,
+            '5th' : TABLE_SCROLLS_DIVINE_LEVEL_5,
+            '6th' : TABLE_SCROLLS_DIVINE_LEVEL_6,
+            '7th' : TABLE_SCROLLS_DIVINE_LEVEL_7,
+            '8th' : TABLE_SCROLLS_DIVINE_LEVEL_8,
+            '9th' : TABLE_SCROLLS_DIVINE_LEVEL_9
+            }
+
+
     def __init__(self):
         Item.__init__(self, KEY_SCROLL)
-        # Load tables.
-        self.t_random = TABLE_RANDOM_SCROLLS
-        self.t_type = TABLE_SCROLL_TYPE
-        self.t_arcane_level_0 = TABLE_SCROLLS_ARCANE_LEVEL_0
-        self.t_arcane_level_1 = TABLE_SCROLLS_ARCANE_LEVEL_1
-        self.t_arcane_level_2 = TABLE_SCROLLS_ARCANE_LEVEL_2
-        self.t_arcane_level_3 = TABLE_SCROLLS_ARCANE_LEVEL_3
-        self.t_arcane_level_4 = TABLE_SCROLLS_ARCANE_LEVEL_4
-        self.t_arcane_level_5 = TABLE_SCROLLS_ARCANE_LEVEL_5
-        self.t_arcane_level_6 = TABLE_SCROLLS_ARCANE_LEVEL_6
-        self.t_arcane_level_7 = TABLE_SCROLLS_ARCANE_LEVEL_7
-        self.t_arcane_level_8 = TABLE_SCROLLS_ARCANE_LEVEL_8
-        self.t_arcane_level_9 = TABLE_SCROLLS_ARCANE_LEVEL_9
-        self.t_divine_level_0 = TABLE_SCROLLS_DIVINE_LEVEL_0
-        self.t_divine_level_1 = TABLE_SCROLLS_DIVINE_LEVEL_1
-        self.t_divine_level_2 = TABLE_SCROLLS_DIVINE_LEVEL_2
-        self.t_divine_level_3 = TABLE_SCROLLS_DIVINE_LEVEL_3
-        self.t_divine_level_4 = TABLE_SCROLLS_DIVINE_LEVEL_4
-        self.t_divine_level_5 = TABLE_SCROLLS_DIVINE_LEVEL_5
-        self.t_divine_level_6 = TABLE_SCROLLS_DIVINE_LEVEL_6
-        self.t_divine_level_7 = TABLE_SCROLLS_DIVINE_LEVEL_7
-        self.t_divine_level_8 = TABLE_SCROLLS_DIVINE_LEVEL_8
-        self.t_divine_level_9 = TABLE_SCROLLS_DIVINE_LEVEL_9
         # Scroll details
         self.spell = ''
         self.arcaneness = ''
@@ -1510,48 +2326,13 @@ class Scroll(Item):
         roll = self.roll('1d100', purpose)
         # Note that unlike potions, there are uncommon level 0 scrolls.
         result = None
+        table = None
         if self.arcaneness == 'arcane':
-            if self.spell_level == '0':
-                result = self.t_arcane_level_0.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '1st':
-                result = self.t_arcane_level_1.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '2nd':
-                result = self.t_arcane_level_2.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '3rd':
-                result = self.t_arcane_level_3.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '4th':
-                result = self.t_arcane_level_4.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '5th':
-                result = self.t_arcane_level_5.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '6th':
-                result = self.t_arcane_level_6.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '7th':
-                result = self.t_arcane_level_7.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '8th':
-                result = self.t_arcane_level_8.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '9th':
-                result = self.t_arcane_level_9.find_roll(conn, roll, commonness, purpose, listener)
+            table = self.t_arcane.get(self.spell_level)
         elif self.arcaneness == 'divine':
-            if self.spell_level == '0':
-                result = self.t_divine_level_0.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '1st':
-                result = self.t_divine_level_1.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '2nd':
-                result = self.t_divine_level_2.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '3rd':
-                result = self.t_divine_level_3.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '4th':
-                result = self.t_divine_level_4.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '5th':
-                result = self.t_divine_level_5.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '6th':
-                result = self.t_divine_level_6.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '7th':
-                result = self.t_divine_level_7.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '8th':
-                result = self.t_divine_level_8.find_roll(conn, roll, commonness, purpose, listener)
-            elif self.spell_level == '9th':
-                result = self.t_divine_level_9.find_roll(conn, roll, commonness, purpose, listener)
+            table = self.t_divine.get(self.spell_level)
+        if table:
+            result = table.find_roll(conn, roll, commonness, purpose, listener)
         self.spell = result['Result']
 
         # Subtype
@@ -1567,10 +2348,12 @@ class Scroll(Item):
 
 class Staff(Item):
 
+    # Tables, shared by every instance.
+    t_staves = TABLE_STAVES
+
+
     def __init__(self):
         Item.__init__(self, KEY_STAFF)
-        # Load tables.
-        self.t_staves = TABLE_STAVES
         # Staff details.
         self.staff = ''
         self.price = ''
@@ -1601,16 +2384,21 @@ class Staff(Item):
 
 class Wand(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_RANDOM_WANDS
+    t_type = TABLE_WAND_TYPE
+    # Spell tables, by spell level.
+    t_wands = {
+            '0' : TABLE_WAND_LEVEL_0,
+            '1st' : TABLE_WAND_LEVEL_1,
+            '2nd' : TABLE_WAND_LEVEL_2,
+            '3rd' : TABLE_WAND_LEVEL_3,
+            '4th' : TABLE_WAND_LEVEL_4
+            }
+
+
     def __init__(self):
         Item.__init__(self, KEY_WAND)
-        # Load tables.
-        self.t_random = TABLE_RANDOM_WANDS
-        self.t_type = TABLE_WAND_TYPE
-        self.t_wands_0 = TABLE_WAND_LEVEL_0
-        self.t_wands_1 = TABLE_WAND_LEVEL_1
-        self.t_wands_2 = TABLE_WAND_LEVEL_2
-        self.t_wands_3 = TABLE_WAND_LEVEL_3
-        self.t_wands_4 = TABLE_WAND_LEVEL_4
         # Wand details.
         self.spell = ''
         self.spell_level = ''
@@ -1643,16 +2431,9 @@ class Wand(Item):
         purpose = 'wand spell'
         roll = self.roll('1d100', purpose)
         result = None
-        if self.spell_level == '0':
-            result = self.t_wands_0.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '1st':
-            result = self.t_wands_1.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '2nd':
-            result = self.t_wands_2.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '3rd':
-            result = self.t_wands_3.find_roll(conn, roll, commonness, purpose, listener)
-        elif self.spell_level == '4th':
-            result = self.t_wands_4.find_roll(conn, roll, commonness, purpose, listener)
+        table = self.t_wands.get(self.spell_level)
+        if table:
+            result = table.find_roll(conn, roll, commonness, purpose, listener)
         self.spell = result['Result']
 
         # Subtype
@@ -1668,10 +2449,12 @@ class Wand(Item):
 
 class Gem(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_RANDOM_GEMS
+
+
     def __init__(self):
         Item.__init__(self, KEY_GEM)
-        # Load the table.
-        self.t_random = TABLE_RANDOM_GEMS
         # Gem details.
         self.gem = ''
         self.price = ''
@@ -1715,10 +2498,12 @@ class Gem(Item):
 
 class ArtObject(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_RANDOM_ART_OBJECTS
+
+
     def __init__(self):
         Item.__init__(self, KEY_ART_OBJECT)
-        # Load the table.
-        self.t_random = TABLE_RANDOM_ART_OBJECTS
         # Art object details.
         self.obj = ''
         self.price = ''
@@ -1747,22 +2532,24 @@ class ArtObject(Item):
 
 class WondrousItem(Item):
 
+    # Tables, shared by every instance.
+    t_random = TABLE_WONDROUS_ITEMS
+    t_belt = TABLE_WONDROUS_ITEMS_BELT
+    t_body = TABLE_WONDROUS_ITEMS_BODY
+    t_chest = TABLE_WONDROUS_ITEMS_CHEST
+    t_eyes = TABLE_WONDROUS_ITEMS_EYES
+    t_feet = TABLE_WONDROUS_ITEMS_FEET
+    t_hands = TABLE_WONDROUS_ITEMS_HANDS
+    t_head = TABLE_WONDROUS_ITEMS_HEAD
+    t_headband = TABLE_WONDROUS_ITEMS_HEADBAND
+    t_neck = TABLE_WONDROUS_ITEMS_NECK
+    t_shoulders = TABLE_WONDROUS_ITEMS_SHOULDERS
+    t_slotless = TABLE_WONDROUS_ITEMS_SLOTLESS
+    t_wrists = TABLE_WONDROUS_ITEMS_WRISTS
+
+
     def __init__(self):
         Item.__init__(self, KEY_WONDROUS_ITEM)
-        # Load tables.
-        self.t_random = TABLE_WONDROUS_ITEMS
-        self.t_belt = TABLE_WONDROUS_ITEMS_BELT
-        self.t_body = TABLE_WONDROUS_ITEMS_BODY
-        self.t_chest = TABLE_WONDROUS_ITEMS_CHEST
-        self.t_eyes = TABLE_WONDROUS_ITEMS_EYES
-        self.t_feet = TABLE_WONDROUS_ITEMS_FEET
-        self.t_hands = TABLE_WONDROUS_ITEMS_HANDS
-        self.t_head = TABLE_WONDROUS_ITEMS_HEAD
-        self.t_headband = TABLE_WONDROUS_ITEMS_HEADBAND
-        self.t_neck = TABLE_WONDROUS_ITEMS_NECK
-        self.t_shoulders = TABLE_WONDROUS_ITEMS_SHOULDERS
-        self.t_slotless = TABLE_WONDROUS_ITEMS_SLOTLESS
-        self.t_wrists = TABLE_WONDROUS_ITEMS_WRISTS
         # Wondrous item details
         self.slot = ''
         self.item = ''
@@ -1860,10 +2647,8 @@ if __name__ == '__main__':
     def test(price, expected_str):
         p = Price(price)
         print('Test: "', price, '" --> ', p, ' = ', expected_str, sep='')
-        assert(p.as_float() == expected_str)
+        assert(str(p) == expected_str)
 
-    # These tests don't work in European locales, but I'm not too concerned
-    # at the moment.
     test(0  , '0.00 gp')
     test(0.5, '0.50 gp')
     test(1.5, '1.50 gp')
@@ -23,6 +23,8 @@ expressions for generating random rolls for the Pathfinder Item Generator.
 from __future__ import print_function
 
 import random
+import re
+from fractions import Fraction
 from sys import stdin, stdout
 
 random.seed()
@@ -35,44 +37,212 @@ MAX_FORM_DICE = 4
 # Maximum number of sides on a die on a form dice expression.
 MAX_FORM_SIDES = 6
 
+# Number of d100 rolls a PseudorandomRoller draws at a time.
+D100_BLOCK_SIZE = 64
+
+# Dice expressions: XdY, XdY+Z, XdY-Z, or a constant.
+RE_DICE_EXPRESSION = re.compile(r'^(?:(\d*)d(\d+)([+-]\d+)?|([+-]?\d+))$')
+
+# Most compiled dice expressions to keep.  Expressions can come from web
+# forms, so the cache is emptied when it grows past this.
+MAX_CACHED_EXPRESSIONS = 256
+
+# Compiled dice expressions, by the text they were compiled from.
+DICE_EXPRESSIONS = {}
+
 #
 # Utility Functions
 
-# Dice Expression Parser
-# Returns (number_of_dice, die_sides)
-def parseDiceExpression(dice_expression):
-    (number_str, sides_str) = dice_expression.split('d')
-    return (int(number_str), int(sides_str))
-
 # Roll virtual dice
 def roll_dice_impl(number, sides):
     rolls = [random.randrange(1, sides + 1) for x in range(number)]
     return (sum(rolls), rolls)
 
+# Roll many d100s at once
+def roll_d100_block(count):
+    return D100.roll_many(count)
+
 # Roll virtual dice
+# Returns (total, list_of_dice)
 def rollDice(dice_expression):
-    (number, sides) = parseDiceExpression(dice_expression)
-    return roll_dice_impl(number, sides)
+    return compile_dice(dice_expression).roll_dice()
 
-# Roll a dice expression, or return a straight-up value.
-def roll_form(expression):
-    # Try it as a straight integer.
+# Get the compiled form of a dice expression, compiling it only the first
+# time.  Raises ValueError if it is not a dice expression.
+def compile_dice(dice_expression):
     try:
-        as_int = int(expression)
-        return min(as_int, MAX_FORM_COUNT)
-    except ValueError:
+        return DICE_EXPRESSIONS[dice_expression]
+    except KeyError:
         pass
-    # Try it as a dice expression.
+    m = RE_DICE_EXPRESSION.match(dice_expression.replace(' ', ''))
+    if not m:
+        raise ValueError('invalid dice expression: ' + dice_expression)
+    if m.group(4) is not None:
+        dice = DiceExpression(0, 0, int(m.group(4)))
+    else:
+        dice = DiceExpression(int(m.group(1) or 1), int(m.group(2)),
+                int(m.group(3) or 0))
+    if len(DICE_EXPRESSIONS) >= MAX_CACHED_EXPRESSIONS:
+        DICE_EXPRESSIONS.clear()
+    DICE_EXPRESSIONS[dice_expression] = dice
+    return dice
+
+# Make the text of a roll log entry: either a description string, or a roll
+# event logged by Roller.log_roll.
+def render_log_line(line):
+    if not isinstance(line, tuple):
+        return line
+    (purpose, dice_expression, result) = line
+    if dice_expression is None:
+        return 'Using constant ' + str(result) + ' for ' + purpose
+    if isinstance(result, tuple):
+        (total, dice) = result
+    else:
+        (total, dice) = (result, [result])
+    return 'Rolling ' + dice_expression + ' for ' + purpose + \
+            ',  got ' + str(dice) + ' = ' + str(total)
+
+# Roll a dice expression, or return a straight-up value.
+def roll_form(expression):
     try:
-        number, sides = parseDiceExpression(expression)
-        if number < 1: number = 1
-        if sides < 1: sides = 1
-        return roll_dice_impl(min(number, MAX_FORM_DICE),
-                min(sides, MAX_FORM_SIDES) )
+        dice = compile_dice(expression)
     except ValueError:
-        pass
-    # Invalid
-    return 0
+        # Invalid
+        return 0
+    if dice.is_constant():
+        return min(dice.modifier, MAX_FORM_COUNT)
+    return dice.limit(MAX_FORM_DICE, MAX_FORM_SIDES).roll()
+
+
+#
+# Dice Expressions
+
+# A dice expression, parsed once: a number of dice with the same number of
+# sides, plus a modifier.  A constant has no dice, only the modifier.
+class DiceExpression(object):
+
+    def __init__(self, number, sides, modifier=0):
+        self.number = number
+        self.sides = sides
+        self.modifier = modifier
+        self.text = None
+        self.outcomes = None
+
+    def __str__(self):
+        if self.text is None:
+            if self.is_constant():
+                self.text = str(self.modifier)
+            else:
+                self.text = str(self.number) + 'd' + str(self.sides)
+                if self.modifier > 0:
+                    self.text += '+' + str(self.modifier)
+                elif self.modifier < 0:
+                    self.text += str(self.modifier)
+        return self.text
+
+    def is_constant(self):
+        return self.number == 0 or self.sides == 0
+
+    # Get an expression with at most 'max_number' dice of at most 'max_sides'
+    # sides, and at least one of each.
+    def limit(self, max_number, max_sides):
+        number = max(1, min(self.number, max_number))
+        sides = max(1, min(self.sides, max_sides))
+        if number == self.number and sides == self.sides:
+            return self
+        return DiceExpression(number, sides, self.modifier)
+
+    # Roll the dice, returning (total, list_of_dice).
+    def roll_dice(self):
+        if self.is_constant():
+            return (self.modifier, [])
+        (total, rolls) = roll_dice_impl(self.number, self.sides)
+        return (total + self.modifier, rolls)
+
+    # Roll the dice, returning only the total.
+    def roll(self):
+        if self.is_constant():
+            return self.modifier
+        if self.number == 1:
+            return random.randrange(1, self.sides + 1) + self.modifier
+        return roll_dice_impl(self.number, self.sides)[0] + self.modifier
+
+    # Roll the dice 'count' times, returning a list of totals.
+    def roll_many(self, count):
+        if self.is_constant():
+            return [self.modifier] * count
+        rand = random.random
+        sides = self.sides
+        base = self.number + self.modifier
+        if self.number == 1:
+            return [int(rand() * sides) + base for x in range(count)]
+        dice = range(self.number)
+        return [sum([int(rand() * sides) for d in dice]) + base
+                for x in range(count)]
+
+    # Get the exact chance of each total, as a sorted list of (total,
+    # Fraction) pairs.
+    def distribution(self):
+        if self.outcomes is None:
+            # Convolve one die at a time into the ways of making each total.
+            ways = {0: 1}
+            if not self.is_constant():
+                for d in range(self.number):
+                    added = {}
+                    for (total, count) in ways.items():
+                        for face in range(1, self.sides + 1):
+                            added[total + face] = \
+                                    added.get(total + face, 0) + count
+                    ways = added
+            space = sum(ways.values())
+            self.outcomes = [(total + self.modifier, Fraction(count, space))
+                    for (total, count) in sorted(ways.items())]
+        return self.outcomes
+
+
+# The die behind every table lookup.
+D100 = DiceExpression(1, 100)
+
+
+#
+# Weighted Sampling
+
+# Picks indices at random, in proportion to a list of weights, in constant
+# time per pick (Vose's alias method).
+class AliasTable(object):
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        if count == 0 or total <= 0:
+            raise ValueError('nothing to sample from')
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+        # Scale the weights so they average 1, then pair each underfull
+        # column with an overfull one that tops it up.
+        scaled = [w * count / total for w in weights]
+        small = [i for i in range(count) if scaled[i] < 1.0]
+        large = [i for i in range(count) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Anything left over is full, give or take rounding.
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self):
+        i = int(random.random() * len(self.prob))
+        if random.random() < self.prob[i]:
+            return i
+        return self.alias[i]
 
 
 #
@@ -81,7 +251,11 @@ def roll_form(expression):
 # Base class for dice rollers
 class Roller(object):
 
-    def __init__(self):
+    def __init__(self, log_rolls=True):
+        # Whether to keep a log at all.  Without one, rolls are only counted.
+        self.log_rolls = log_rolls
+        # The log, as description strings and (purpose, expression, result)
+        # roll events.  Roll events are only made into text by get_log.
         self.loglines = []
         self.pending = None
         self.rollcount = 0
@@ -92,13 +266,15 @@ class Roller(object):
         # 0 is an invalid value.
         return 0
 
+    # Log a roll.  The result is a (total, list of dice) pair, or just the
+    # value of a single die.
     def log_roll(self, dice_expression, purpose, result):
-        line = 'Rolling ' + dice_expression + ' for ' + purpose + \
-                ',  got ' + str(result[1]) + ' = ' + str(result[0])
-        self.log(line)
+        self.log((purpose, dice_expression, result))
 
     def log(self, line):
         self.rollcount += 1
+        if not self.log_rolls:
+            return
         # If an item is pending, use that list.
         # Otherwise use the main log.
         if (self.pending is not None):
@@ -108,14 +284,15 @@ class Roller(object):
 
     def start_session(self, description):
         # Log the session type.
-        self.loglines.append(description)
+        if self.log_rolls:
+            self.loglines.append(description)
         # End any pending items.
         self.pending = None
 
     def start_item(self, description):
         # Make the pending list valid.
-        self.pending = []
-        self.pending.append(description)
+        if self.log_rolls:
+            self.pending = [description]
 
     def cancel_item(self):
         # Make the pending list invalid.
@@ -132,7 +309,7 @@ class Roller(object):
         self.pending = None
 
     def get_log(self):
-        return self.loglines
+        return [render_log_line(line) for line in self.loglines]
 
     def get_rollcount(self):
         return self.rollcount
@@ -140,57 +317,53 @@ class Roller(object):
 
 class PseudorandomRoller(Roller):
 
-    def __init__(self):
-        Roller.__init__(self)
+    def __init__(self, log_rolls=True):
+        Roller.__init__(self, log_rolls)
+        # d100 rolls drawn ahead of time, used from the end.
+        self.d100_pool = []
 
     # Roll a random number using the handy-dandy function we have here.
     def roll(self, dice_expression, purpose):
 
-        # Try it as a straight integer.
-        try:
-            as_int = int(dice_expression)
-            self.log('Using constant ' + str(as_int) + ' for ' + purpose)
-            return min(as_int, MAX_FORM_COUNT)
-        except ValueError:
-            pass
-        # Try it as a dice expression.
+        # Table lookups are nearly all d100s, so serve them from the pool.
+        if dice_expression == '1d100':
+            if not self.d100_pool:
+                self.d100_pool = roll_d100_block(D100_BLOCK_SIZE)
+            value = self.d100_pool.pop()
+            if self.log_rolls:
+                Roller.log_roll(self, dice_expression, purpose, value)
+            else:
+                self.rollcount += 1
+            return value
+
         try:
-            number, sides = parseDiceExpression(dice_expression)
-            newexpr = str(number) + "d" + str(sides)
-            result = rollDice(newexpr)
-            Roller.log_roll(self, newexpr, purpose, result)
-            return result[0]
+            dice = compile_dice(dice_expression)
         except ValueError:
-            pass
-
-        # Invalid
-        return 0
+            # Invalid
+            return 0
+        if dice.is_constant():
+            self.log((purpose, None, dice.modifier))
+            return min(dice.modifier, MAX_FORM_COUNT)
+        result = dice.roll_dice()
+        Roller.log_roll(self, str(dice), purpose, result)
+        return result[0]
 
     # Roll a random number using the handy-dandy function we have here.
     def roll_form(self, dice_expression, purpose):
 
-        # Try it as a straight integer.
         try:
-            as_int = int(dice_expression)
-            self.log('Using constant ' + str(as_int) + ' for ' + purpose)
-            return min(as_int, MAX_FORM_COUNT)
+            dice = compile_dice(dice_expression)
         except ValueError:
-            pass
-        # Try it as a dice expression.
-        try:
-            number, sides = parseDiceExpression(dice_expression)
-            if number < 1: number = 1
-            if number > MAX_FORM_DICE: number = MAX_FORM_DICE
-            if sides < 1: sides = 1
-            if sides > MAX_FORM_SIDES: sides = MAX_FORM_SIDES
-            newexpr = str(number) + "d" + str(sides)
-            result = rollDice(newexpr)
-            Roller.log_roll(self, dice_expression + ' --> ' + newexpr, purpose, result)
-            return result
-        except ValueError:
-            pass
-        # Invalid
-        return 0
+            # Invalid
+            return 0
+        if dice.is_constant():
+            self.log((purpose, None, dice.modifier))
+            return min(dice.modifier, MAX_FORM_COUNT)
+        limited = dice.limit(MAX_FORM_DICE, MAX_FORM_SIDES)
+        result = limited.roll_dice()
+        Roller.log_roll(self, dice_expression + ' --> ' + str(limited),
+                purpose, result)
+        return result[0]
 
 
 # Instructs the user via the command line to roll dice and input the results
@@ -231,7 +404,7 @@ class ManualDiceRoller(Roller):
         if value == 0:
             roll = rollDice(dice_expression)
             print('    rolled: ', roll)
-            return roll
+            return roll[0]
         # Done.
         return value
 
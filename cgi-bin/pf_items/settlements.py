@@ -20,6 +20,8 @@ This module performs tasks related to settlement item generation.
 #
 # Standard Imports
 
+import multiprocessing
+import random
 import sqlite3 as sqlite
 import sys
 import traceback
@@ -63,9 +65,23 @@ SETTLEMENT_MAP = {
         'metropolis': 'Metropolis' }
 
 
+#
+# Variables
+
+# Each worker process's connections to the standard and frequency databases
+# (see generate_region).
+WORKER_CONN = None
+WORKER_FREQ_CONN = None
+
+
 #
 # Classes
 
+class SettlementError(Exception):
+    '''Raised for a settlement that cannot be generated as specified.'''
+    pass
+
+
 #
 # Functions
 
@@ -77,14 +93,36 @@ def generate_settlement_items(conn, settlement, roller, **kwargs):
 
     # Create a result in a type that can be serialized into JSON.
     result = {}
+    result['minor_items'] = []
+    result['medium_items'] = []
+    result['major_items'] = []
+    for (group, x) in iter_settlement_items(conn, settlement, roller,
+            **kwargs):
+        if group is None:
+            result.update(x)
+        else:
+            result[group].append(x)
+    return result
+
+
+def iter_settlement_items(conn, settlement, roller, **kwargs):
+    '''Generates a settlement's items one at a time.  Yields (None, summary)
+    first, where the summary is the result of generate_settlement_items
+    without its item lists.  Then it yields (list name, item dict)
+    for each item, where the list name is 'minor_items', 'medium_items' or
+    'major_items'.'''
+    result = {}
 
     list_rolls = kwargs.get('list_rolls', '')
 
+    # Connection to the frequency database, if there is one.
+    freq_conn = kwargs.get('freq_conn')
+
     # Convert the command-line parameter to a dict key string.
     try:
         key = SETTLEMENT_MAP[settlement.lower()]
     except KeyError:
-        raise Exception('no such settlement type: ' + settlement)
+        raise SettlementError('no such settlement type: ' + settlement)
 
     # Start rolling!
 
@@ -93,7 +131,7 @@ def generate_settlement_items(conn, settlement, roller, **kwargs):
             (key,))
     row = cursor.fetchone()
     if row == None:
-        raise Exception('failed to acquire settlement details')
+        raise SettlementError('failed to acquire settlement details')
 
     # Collect details for generation.
     settlement_base = row['Base']
@@ -106,9 +144,6 @@ def generate_settlement_items(conn, settlement, roller, **kwargs):
     result['minor_heading'] = ""
     result['medium_heading'] = ""
     result['major_heading'] = ""
-    result['minor_items'] = []
-    result['medium_items'] = []
-    result['major_items'] = []
 
     roller.start_session('Start of settlement rolls')
 
@@ -120,31 +155,34 @@ def generate_settlement_items(conn, settlement, roller, **kwargs):
     count_medium = roller.roll(expr_medium, 'number of medium items')
     count_major = roller.roll(expr_major, 'number of major items')
 
-    # Generate the minor magic items.  Remember we can get a '*' in a
-    # metropolis.
-    if count_minor > 0 or expr_minor == '*':
-        if expr_minor == '*':
-            result['minor_heading'] = 'This ' + key.lower() + \
-                    ' has virtually every minor magic item.'
-        else:
-            for i in range(count_minor):
-                x = get_random_item(conn, 'minor', roller, settlement_base)
-                result['minor_items'].append(x.get_dict())
+    # Remember we can get a '*' in a metropolis.
+    if expr_minor == '*':
+        result['minor_heading'] = 'This ' + key.lower() + \
+                ' has virtually every minor magic item.'
+
+    # The details are known; the items follow.
+    yield (None, result)
+
+    # Generate the minor magic items.
+    if count_minor > 0 and expr_minor != '*':
+        for i in range(count_minor):
+            x = get_random_item(conn, 'minor', roller,
+                    settlement_base, freq_conn)
+            yield ('minor_items', x.get_dict())
 
     # Generate the medium magic items.
     if count_medium > 0:
         for i in range(count_medium):
-            x = get_random_item(conn, 'medium', roller, settlement_base)
-            result['medium_items'].append(x.get_dict())
+            x = get_random_item(conn, 'medium', roller,
+                    settlement_base, freq_conn)
+            yield ('medium_items', x.get_dict())
 
     # Generate the major magic items.
     if count_major > 0:
         for i in range(count_major):
-            x = get_random_item(conn, 'major', roller, settlement_base)
-            result['major_items'].append(x.get_dict())
-
-    # Return the resulting collection.
-    return result
+            x = get_random_item(conn, 'major', roller,
+                    settlement_base, freq_conn)
+            yield ('major_items', x.get_dict())
 
 
 def generate_custom(conn, roller, base_value, q_ls_min, q_gt_min, q_ls_med,
@@ -188,11 +226,91 @@ def generate_custom(conn, roller, base_value, q_ls_min, q_gt_min, q_ls_med,
     return result
 
 
-def get_random_item(conn, strength, roller, base_value):
-    x = item.generate_generic(conn, strength, roller, base_value)
+def get_random_item(conn, strength, roller, base_value, freq_conn=None):
+    x = item.generate_generic(conn, strength, roller, base_value,
+            freq_conn=freq_conn)
     return x
 
 
+def generate_settlement(conn, freq_conn, params, roller):
+    '''Generates the items of one settlement, described by the parameters of
+    a web request: its 'size', or, without one, the parameters of a custom
+    settlement ('base_value', 'q_ls_min', and so on), which are generated from
+    the frequency database.'''
+    if params.get('size'):
+        return generate_settlement_items(conn, params['size'], roller,
+                freq_conn=freq_conn)
+    if freq_conn is None:
+        raise SettlementError(
+                'custom settlements need the frequency database')
+    quantities = [params.get(q) or '1' for q in ['q_ls_min', 'q_gt_min',
+        'q_ls_med', 'q_gt_med', 'q_ls_maj', 'q_gt_maj']]
+    return generate_custom(freq_conn, roller, params.get('base_value') or 0,
+            *quantities)
+
+
+def init_worker(database, freq_database):
+    '''Sets up a worker process.  The random number generator is seeded
+    again, or forked workers would all make the same rolls.'''
+    random.seed()
+    open_worker(database, freq_database)
+
+
+def open_worker(database, freq_database):
+    '''Opens the connections that run_job uses.'''
+    global WORKER_CONN, WORKER_FREQ_CONN
+    WORKER_CONN = item.connect_read_only(database)
+    if freq_database:
+        WORKER_FREQ_CONN = item.connect_read_only(freq_database)
+
+
+def close_worker():
+    global WORKER_CONN, WORKER_FREQ_CONN
+    for conn in [WORKER_CONN, WORKER_FREQ_CONN]:
+        if conn: conn.close()
+    WORKER_CONN = None
+    WORKER_FREQ_CONN = None
+
+
+def run_job(job):
+    '''Generates one settlement in a worker process, returning its name and
+    its items, or a dict with only an 'error' if its parameters were bad.
+    Any other exception is raised, and stops the region.'''
+    (name, params) = job
+    try:
+        result = generate_settlement(WORKER_CONN, WORKER_FREQ_CONN, params,
+                rollers.PseudorandomRoller(log_rolls=False))
+    except SettlementError as e:
+        result = {'error': str(e)}
+    return (name, result)
+
+
+def generate_region(region, database, freq_database=None, jobs=1):
+    '''Generates the items of many settlements, given as (name, parameters)
+    pairs, with the parameters taken by generate_settlement.  Yields (name,
+    result) pairs as each settlement is finished, which, with more than one
+    job, is not necessarily the order they were given in.  Each job is a
+    worker process opening the databases itself.'''
+    if jobs <= 1:
+        open_worker(database, freq_database)
+        try:
+            for job in region:
+                yield run_job(job)
+        finally:
+            close_worker()
+        return
+
+    pool = multiprocessing.Pool(jobs, init_worker, (database, freq_database))
+    try:
+        # One settlement per task, so each is passed on as soon as it's done.
+        for result in pool.imap_unordered(run_job, region, 1):
+            yield result
+    finally:
+        # Everything is in, or nobody wants the rest.
+        pool.terminate()
+        pool.join()
+
+
 #
 # Execution
 
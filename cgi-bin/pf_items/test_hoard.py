@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8
+
+# Pathfinder Item Generator
+#
+# Copyright 2012-2014, Steven Clark.
+#
+# This program is free software, and is provided "as is", without warranty of
+# any kind, express or implied, to the extent permitted by applicable law.
+# See the full license in the file 'LICENSE'.
+#
+# This software includes Open Game Content.  See the file 'OGL' for more
+# information.
+#
+'''
+This module tests the fitting of treasure to a budget in hoard.py.  Run it
+from the directory it is in.
+'''
+
+from __future__ import print_function
+
+import hoard
+import item
+import webgen
+
+CONN = item.connect_read_only('data/data.db')
+
+
+def get_lots(requests):
+    '''Returns the (treasure type, row, count) of each fitted row.'''
+    return [(tt, r['index'], r['count']) for tt in requests
+            for r in requests[tt]]
+
+
+def get_cost(requests, types):
+    table = hoard.get_treasure_list(CONN, types)
+    return sum(table[tt][index]['cost'] * count
+            for (tt, index, count) in get_lots(requests))
+
+
+def best_total(budget, types):
+    '''Finds the closest total to the budget the slow way, by tallying every
+    total that the lots can make.'''
+    table = hoard.get_treasure_list(CONN, types)
+    totals = set([0])
+    for tt in types:
+        for row in table[tt]:
+            cost = row['cost']
+            if cost <= 0 or cost > budget:
+                continue
+            for n in range(min(budget // cost, hoard.MAX_TREASURE_LOTS)):
+                totals |= set(t + cost for t in totals if t + cost <= budget)
+    return max(totals)
+
+
+def test_fit_is_exact():
+    for (budget, types) in [(0, 'a'), (5, 'a'), (999, 'b'), (1234, 'abc'),
+            (2500, 'de'), (4321, 'abcdefghi')]:
+        (requests, total) = hoard.fit_treasure(CONN, budget, types)
+        assert total == get_cost(requests, types), (budget, types)
+        assert total == best_total(budget, types), (budget, types)
+        for (tt, index, count) in get_lots(requests):
+            assert tt in types and 0 < count <= hoard.MAX_TREASURE_LOTS
+
+
+def test_fit_takes_few_lots():
+    (requests, total) = hoard.fit_treasure(CONN, 3000, 'ab')
+    assert total == 3000
+    assert sum(count for (tt, index, count) in get_lots(requests)) <= 5
+    # Not just coins, which are the cheapest lots of type A.
+    (requests, total) = hoard.fit_treasure(CONN, 1000000, 'abcdefghi')
+    assert 999000 <= total <= 1000000
+    assert sum(count for (tt, index, count) in get_lots(requests)) <= 20
+    assert list(requests) != ['a']
+
+
+def test_fit_coarse_units():
+    # Too many totals to fit exactly: the fit comes close, but never over.
+    budget = 10 * hoard.MAX_FIT_BUDGET
+    (requests, total) = hoard.fit_treasure(CONN, budget, 'ghi')
+    assert total == get_cost(requests, 'ghi')
+    assert budget * 0.99 <= total <= budget
+
+
+def test_fit_budget_cap():
+    result = webgen.run_webgen_internal({'mode': 'hoard_fit',
+        'type': 'custom', 'custom_gp': '10000000', 'type_a': 'true'})
+    assert result == 'Error: cannot fit a budget over 1,000,000 gp', result
+    result = webgen.run_webgen_internal({'mode': 'hoard_fit',
+        'type': 'custom', 'custom_gp': '3000', 'type_a': 'true',
+        'type_b': 'true'})
+    assert result['total'] == 3000
+    assert len(result['treasure']) <= 5
+
+
+if __name__ == '__main__':
+    for (name, test) in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8
+
+# Pathfinder Item Generator
+#
+# Copyright 2012-2014, Steven Clark.
+#
+# This program is free software, and is provided "as is", without warranty of
+# any kind, express or implied, to the extent permitted by applicable law.
+# See the full license in the file 'LICENSE'.
+#
+# This software includes Open Game Content.  See the file 'OGL' for more
+# information.
+#
+'''
+This module tests item.py: prices, the roll table snapshot, and the sampling
+of enumerated items.  Run it from the directory it is in.  The tests against
+the frequency database are skipped if enumerate.py hasn't built one.
+'''
+
+from __future__ import print_function
+
+import collections
+import locale
+import math
+import os
+import random
+
+import item
+import rollers
+
+CONN = item.connect_read_only('data/data.db')
+
+FREQ_CONN = None
+if os.path.isfile('data/freq.db'):
+    FREQ_CONN = item.connect_read_only('data/freq.db')
+
+
+def check_shares(counts, weights, n):
+    '''Checks that each of 'n' draws, tallied in 'counts', came up about in
+    proportion to 'weights', both keyed alike.'''
+    total = float(sum(weights.values()))
+    for key in set(counts) | set(weights):
+        p = weights.get(key, 0) / total
+        assert key in weights, key
+        # Within five standard deviations, plus a little.
+        error = 5 * math.sqrt(p * (1 - p) / n) + 0.001
+        assert abs(counts[key] / float(n) - p) <= error, (key, counts[key], p)
+
+
+def check_same_tables(store, loaded):
+    '''Checks that the tables a TableStore gets are the ones 'loaded' read
+    from the database.'''
+    for name in loaded.names:
+        groups = store.get(CONN, name)
+        expected = loaded.tables[name]
+        assert sorted(groups, key=str) == sorted(expected, key=str), name
+        for strength in expected:
+            (rows, slots, branches) = groups[strength]
+            (loaded_rows, loaded_slots, loaded_branches) = expected[strength]
+            assert list(slots) == list(loaded_slots), name
+            assert list(branches) == list(loaded_branches), name
+            assert len(rows) == len(loaded_rows), name
+            for (row, loaded_row) in zip(rows, loaded_rows):
+                assert list(row.keys()) == list(loaded_row.keys()), name
+                assert list(row) == list(loaded_row), name
+                assert [type(v) for v in row] == \
+                        [type(v) for v in loaded_row], name
+
+
+def test_snapshot_round_trip():
+    loaded = item.TableStore()
+    loaded.names = list(item.TABLE_STORE.names)
+    loaded.load(CONN)
+    fingerprint = b'f' * 20
+    data = loaded.dump_snapshot(fingerprint)
+    # Reading the snapshot remembers the prices it holds.
+    item.PRICE_CACHE.clear()
+    store = item.TableStore()
+    store.names = loaded.names
+    store.tables = {}
+    store.snapshot = item.TableSnapshot(data, fingerprint)
+    check_same_tables(store, loaded)
+    prices = dict(item.PRICE_CACHE)
+    assert len(prices) > 0
+    item.PRICE_CACHE.clear()
+    for (price_str, parsed) in prices.items():
+        assert item.parse_price(price_str) == parsed, price_str
+    # A snapshot of another database, or in another format, isn't used.
+    for (changed, changed_fingerprint) in [(data, b'g' * 20),
+            (data[:4] + b'\xff' + data[5:], fingerprint)]:
+        try:
+            item.TableSnapshot(changed, changed_fingerprint)
+        except ValueError:
+            continue
+        assert False
+
+
+def test_committed_snapshot():
+    # initdb.py must be run again when the snapshot format changes.
+    store = item.TableStore()
+    store.names = list(item.TABLE_STORE.names)
+    assert store.open_snapshot(CONN)
+    loaded = item.TableStore()
+    loaded.names = store.names
+    loaded.load(CONN)
+    check_same_tables(store, loaded)
+    store.close_snapshot()
+
+
+def test_parse_price():
+    item.PRICE_CACHE.clear()
+    for (price_str, parsed) in [('1,000 gp', (100000, 0)), ('5 sp', (50, 0)),
+            ('3 pp', (3000, 0)), ('7 cp', (7, 0)), ('12', (1200, 0)),
+            ('1 gp 5 sp', (150, 0)), ('2,750 GP', (275000, 0)),
+            ('+2 bonus', (0, 2))]:
+        assert item.parse_price(price_str) == parsed, price_str
+        assert item.PRICE_CACHE[price_str] == parsed, price_str
+    try:
+        item.parse_price('+1 enhancement bonus')
+    except item.BadPrice:
+        pass
+    else:
+        assert False
+    # A bonus is priced once the kind of item is known.
+    assert item.Price('+3 bonus', 'weapon').as_copper() == 1800000
+    price = item.Price('1,000 gp')
+    price.add('+1 bonus')
+    assert price.as_float() == 2000.0
+
+
+def test_format_gp():
+    for (copper, text) in [(0, '0.00 gp'), (5, '0.05 gp'), (100, '1.00 gp'),
+            (100050, '1,000.50 gp'), (123456789, '1,234,567.89 gp'),
+            (-150, '-1.50 gp')]:
+        assert item.format_gp(copper) == text, copper
+    assert str(item.Price('2,750 gp')) == '2,750.00 gp'
+    assert str(item.Price('')) == '<error> gp'
+    # The process locale makes no difference.
+    try:
+        locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
+    except locale.Error:
+        return
+    try:
+        assert item.format_gp(100050) == '1,000.50 gp'
+    finally:
+        locale.setlocale(locale.LC_ALL, 'C')
+
+
+def test_alias_table():
+    random.seed(5)
+    weights = [1, 2, 3, 0, 4, 0.5]
+    alias = rollers.AliasTable(weights)
+    assert len(alias) == len(weights)
+    n = 100000
+    counts = collections.Counter(alias.sample() for i in range(n))
+    assert counts[3] == 0
+    check_shares(counts, dict(enumerate(weights)), n)
+    for weights in [[], [0, 0]]:
+        try:
+            rollers.AliasTable(weights)
+        except ValueError:
+            continue
+        assert False, weights
+
+
+def test_frequency_table():
+    random.seed(6)
+    rows = [{'Item': name, 'Price': price, 'Count': count} for
+            (name, price, count) in [('a', 500.0, 3), ('b', 100.0, 1),
+                ('c', 2000.0, 2), ('d', 500.0, 6), ('e', 50.0, 0)]]
+    table = item.FrequencyTable(rows)
+    assert table.prices == sorted(table.prices)
+    assert table.weight_at_least(0) == 12
+    assert table.weight_at_least(500) == 11
+    assert table.weight_at_least(2001) == 0
+    # The alias table is only built for a draw from every row.
+    n = 40000
+    counts = collections.Counter(table.sample(500)['Item'] for i in range(n))
+    assert table.alias is None
+    check_shares(counts, {'a': 3, 'c': 2, 'd': 6}, n)
+    counts = collections.Counter(table.sample(0)['Item'] for i in range(n))
+    assert table.alias is not None
+    check_shares(counts, {'a': 3, 'b': 1, 'c': 2, 'd': 6}, n)
+    assert table.sample(2001) is None
+    assert item.FrequencyTable([]).sample(0) is None
+
+
+def test_frequency_store():
+    if FREQ_CONN is None:
+        return
+    store = item.FrequencyStore()
+    table = store.get(FREQ_CONN, 'ring_lesser_minor')
+    assert table is store.get(FREQ_CONN, 'ring_lesser_minor')
+    # Only what was asked for is read.
+    assert list(store.tables) == ['ring_lesser_minor']
+    assert store.get(FREQ_CONN, 'no_such_table') is None
+    assert not store.is_loaded()
+
+
+def test_conditional_matches_rejection():
+    '''Items drawn from the enumerated tables, conditioned on their price,
+    should be distributed like items rolled until one is worth enough.'''
+    if FREQ_CONN is None:
+        return
+    random.seed(7)
+    roller = rollers.PseudorandomRoller(log_rolls=False)
+    n = 3000
+    for (strength, base_value) in [('minor', 1000), ('major', 50000)]:
+        (x, acceptance) = item.generate_conditional(CONN, FREQ_CONN, strength,
+                base_value)
+        drawn = collections.Counter()
+        rolled = collections.Counter()
+        for i in range(n):
+            drawn[item.generate_generic(CONN, strength, roller, base_value,
+                freq_conn=FREQ_CONN).subtype] += 1
+            rolled[item.generate_generic(CONN, strength, roller,
+                base_value).subtype] += 1
+        for key in set(drawn) | set(rolled):
+            p = (drawn[key] + rolled[key]) / (2.0 * n)
+            error = 5 * math.sqrt(2 * p * (1 - p) / n) + 0.001
+            assert abs(drawn[key] - rolled[key]) / float(n) <= error, \
+                    (strength, key, drawn[key], rolled[key])
+        # As many items are worth enough as the draw says.
+        worth = 0
+        for i in range(n):
+            x = item.generate_generic(CONN, strength, roller, 0.01)
+            if x.price.as_float() >= base_value:
+                worth += 1
+        error = 5 * math.sqrt(acceptance * (1 - acceptance) / n)
+        assert abs(worth / float(n) - acceptance) <= error, \
+                (strength, worth, acceptance)
+
+
+if __name__ == '__main__':
+    if FREQ_CONN is None:
+        print('No frequency database: skipping the tests that need one')
+    for (name, test) in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8
+
+# Pathfinder Item Generator
+#
+# Copyright 2012-2014, Steven Clark.
+#
+# This program is free software, and is provided "as is", without warranty of
+# any kind, express or implied, to the extent permitted by applicable law.
+# See the full license in the file 'LICENSE'.
+#
+# This software includes Open Game Content.  See the file 'OGL' for more
+# information.
+#
+'''
+This module tests the dice expressions in rollers.py.
+'''
+
+from __future__ import print_function
+
+import collections
+import random
+from fractions import Fraction
+
+import rollers
+
+
+def test_compile_dice():
+    for (text, expected) in [('1d100', '1d100'), ('d6', '1d6'),
+            ('3d4+2', '3d4+2'), ('2d8 - 1', '2d8-1'), ('12', '12'),
+            ('-3', '-3')]:
+        assert str(rollers.compile_dice(text)) == expected, text
+    # Compiled once, then reused.
+    assert rollers.compile_dice('4d4') is rollers.compile_dice('4d4')
+    for text in ['', 'd', '2d', 'x', '1d6+']:
+        try:
+            rollers.compile_dice(text)
+        except ValueError:
+            continue
+        assert False, text
+
+
+def test_distribution():
+    dice = rollers.compile_dice('2d6')
+    outcomes = dict(dice.distribution())
+    assert sorted(outcomes) == list(range(2, 13))
+    assert outcomes[2] == Fraction(1, 36) and outcomes[7] == Fraction(6, 36)
+    # Each total's chance is the number of ways to roll it, over 3**3.
+    outcomes = dict(rollers.compile_dice('3d3+1').distribution())
+    assert [outcomes[t] * 27 for t in range(4, 11)] == [1, 3, 6, 7, 6, 3, 1]
+    assert rollers.compile_dice('1d100').distribution()[0] == \
+            (1, Fraction(1, 100))
+    assert rollers.compile_dice('5').distribution() == [(5, 1)]
+    for text in ['4d4', '3d4', '2d4-1', '1d100']:
+        outcomes = rollers.compile_dice(text).distribution()
+        assert sum(p for (t, p) in outcomes) == 1, text
+
+
+def test_rolls_follow_distribution():
+    random.seed(12)
+    for text in ['4d4', '1d6+2', '2d3-1']:
+        dice = rollers.compile_dice(text)
+        n = 60000
+        counts = collections.Counter(dice.roll_many(n))
+        counts.update(dice.roll() for i in range(n))
+        for (total, p) in dice.distribution():
+            assert abs(counts[total] / (2.0 * n) - float(p)) < 0.01, \
+                    (text, total)
+        assert set(counts) <= set(t for (t, p) in dice.distribution())
+
+
+def test_roll_form():
+    random.seed(12)
+    assert rollers.roll_form('7') == 7
+    assert rollers.roll_form('bogus') == 0
+    # Form dice are limited to a few small dice.
+    assert max(rollers.roll_form('100d100') for i in range(1000)) <= \
+            rollers.MAX_FORM_DICE * rollers.MAX_FORM_SIDES
+
+
+if __name__ == '__main__':
+    for (name, test) in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8
+
+# Pathfinder Item Generator
+#
+# Copyright 2012-2014, Steven Clark.
+#
+# This program is free software, and is provided "as is", without warranty of
+# any kind, express or implied, to the extent permitted by applicable law.
+# See the full license in the file 'LICENSE'.
+#
+# This software includes Open Game Content.  See the file 'OGL' for more
+# information.
+#
+'''
+This module tests region generation in settlements.py, both directly and
+through generate.py.  Run it from the directory it is in.
+'''
+
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+
+import settlements
+
+DATABASE = 'data/data.db'
+
+REGION = [('Sandpoint', {'size': 'village'}), ('Magnimar', {'size': 'hamlet'})]
+
+
+def check_region(results):
+    '''Checks the results of generating REGION.'''
+    assert sorted(name for (name, result) in results) == \
+            ['Magnimar', 'Sandpoint']
+    for (name, result) in results:
+        assert 'error' not in result, result
+        assert 'base_value' in result
+        for group in ['minor_items', 'medium_items', 'major_items']:
+            for x in result[group]:
+                assert x['item'] and x['value_str'].endswith(' gp'), x
+
+
+def test_region_in_process():
+    check_region(list(settlements.generate_region(REGION, DATABASE)))
+
+
+def test_region_in_pool():
+    check_region(list(settlements.generate_region(REGION, DATABASE,
+        jobs=2)))
+
+
+def test_region_bad_settlement():
+    results = list(settlements.generate_region(REGION +
+        [('Nowhere', {'size': 'bogus'})], DATABASE))
+    assert dict(results)['Nowhere'] == \
+            {'error': 'no such settlement type: bogus'}
+    check_region(results[:2])
+
+
+def test_region_command():
+    output = subprocess.check_output([sys.executable, 'generate.py',
+        'region', 'Sandpoint=village', 'Magnimar=hamlet', '--json'])
+    results = [json.loads(line) for line in output.decode('utf-8').split('\n')
+            if line]
+    check_region([(result.pop('name'), result) for result in results])
+
+
+def test_region_command_error():
+    status = subprocess.call([sys.executable, 'generate.py', 'region',
+        'Nowhere=bogus', '--json'], stdout=subprocess.PIPE)
+    assert status == 1
+
+
+if __name__ == '__main__':
+    for (name, test) in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
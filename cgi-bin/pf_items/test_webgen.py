@@ -44,6 +44,8 @@ DATA = [
         '{"mode": "settlement", "size": "large city"}',
         '{"mode": "settlement", "size": "largecity"}',
         '{"mode": "settlement", "size": "metropolis"}',
+        '{"mode": "settlement", "size": "small city", "stream": "true"}',
+        '{"mode": "settlement", "size": "metropolis", "stream": "true", "list_rolls": "true"}',
 
         '{"mode": "custom", "base_value": 1000  , "q_ls_min": "1", "q_gt_min": "1", "q_ls_med": "1", "q_gt_med": "1", "q_ls_maj": "1", "q_gt_maj": "1"}',
         '{"mode": "custom", "base_value": 15000 , "q_ls_min": "1", "q_gt_min": "1", "q_ls_med": "1", "q_gt_med": "1", "q_ls_maj": "1", "q_gt_maj": "1"}',
@@ -237,6 +239,9 @@ DATA = [
         '{"mode": "hoard_budget", "type": "npc_gear", "npc_level": 1, "heroic": "false"}',
         '{"mode": "hoard_types", "type_a": "true"}',
         '{"mode": "hoard_types", "type_a": "true", "type_b": "true", "type_c": "true", "type_d": "true", "type_e": "true", "type_f": "true", "type_g": "true", "type_h": "true", "type_i": "true"}',
+        '{"mode": "hoard_fit", "type": "custom", "custom_gp":"3000", "type_a": "true", "type_b": "true"}',
+        '{"mode": "hoard_fit", "type": "encounter", "apl": 10, "rate": "medium", "magnitude": "double", "type_a": "true", "type_c": "true", "type_e": "true", "type_h": "true"}',
+        '{"mode": "hoard_fit", "type": "custom", "custom_gp":"10000000", "type_g": "true", "type_h": "true", "type_i": "true"}',
         ]
 
 OVERRIDE_DATA = [
@@ -268,3 +273,7 @@ for tt in basis:
 basis['mode'] = "hoard_generate"
 
 webgen.run_webgen(basis)
+
+# Once more, streamed.
+basis['stream'] = "true"
+webgen.run_webgen(basis)
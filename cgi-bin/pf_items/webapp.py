@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+# vim: set fileencoding=utf-8
+
+# Pathfinder Item Generator
+#
+# Copyright 2012-2014, Steven Clark.
+#
+# This program is free software, and is provided "as is", without warranty of
+# any kind, express or implied, to the extent permitted by applicable law.
+# See the full license in the file 'LICENSE'.
+#
+# This software includes Open Game Content.  See the file 'OGL' for more
+# information.
+#
+'''
+This module is a WSGI interface for item generation.  It accepts the same JSON
+requests as webgen.py, and returns the same JSON responses, but runs in a
+long-lived process, so the modules, database connections, and compiled tables
+stay loaded between requests.  The parameters can also be sent in a GET query
+string, which lets clients revalidate the answers that only change with the
+data.
+'''
+
+
+#
+# Standard Imports
+
+from __future__ import print_function
+
+import json
+import os
+import os.path
+import random
+import sys
+
+
+#
+# Local Imports
+
+import webgen
+
+
+#
+# Module initialization
+
+# Find the databases relative to this file, whatever the server's working
+# directory is, and keep the connections open.
+webgen.DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        'data')
+webgen.KEEP_CONNECTIONS = True
+
+
+#
+# Variables
+
+# Process that last seeded the random number generator.  Servers that fork
+# workers after importing this module would otherwise share a random state.
+SEEDED_PID = None
+
+
+#
+# Execution
+
+def respond(start_response, status, body, headers=[]):
+    start_response(status, [
+        ('Content-Type', 'application/json; charset=UTF-8'),
+        ('Content-Length', str(len(body)))] + headers)
+    return [body]
+
+
+def stream(params):
+    for chunk in webgen.iterate_webgen(params):
+        yield (json.dumps(chunk) + '\n').encode('utf-8')
+
+
+def application(environ, start_response):
+    global SEEDED_PID
+    if SEEDED_PID != os.getpid():
+        random.seed()
+        SEEDED_PID = os.getpid()
+
+    method = environ.get('REQUEST_METHOD', 'GET')
+    if method == 'GET':
+        # The parameters can also be given in the query string, so the
+        # answers that can be cached are.
+        params = webgen.get_query_params(environ.get('QUERY_STRING', ''))
+    elif method != 'POST':
+        return respond(start_response, '405 Method Not Allowed', b'""\n')
+    else:
+        # Read the request, which is the same JSON that webgen.py reads from
+        # standard input.
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        try:
+            data = environ['wsgi.input'].read(length)
+            params = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return respond(start_response, '400 Bad Request', b'""\n')
+
+    # Answer from memory, if possible, or say the client already has it.
+    static = webgen.get_static_response(params)
+    if static is not None:
+        (body, etag, modified) = static
+        headers = [('ETag', etag), ('Last-Modified', modified),
+                ('Cache-Control', 'no-cache')]
+        if webgen.is_not_modified(environ, etag, modified):
+            start_response('304 Not Modified', headers)
+            return [b'']
+        return respond(start_response, '200 OK',
+                (body + '\n').encode('utf-8'), headers)
+
+    # Stream the result, if asked, a line of JSON at a time.
+    if params.get('stream', '') == 'true':
+        start_response('200 OK', [
+            ('Content-Type', 'application/x-ndjson; charset=UTF-8')])
+        return stream(params)
+
+    # Obtain the result, and output it as webgen.py would.
+    result = webgen.run_webgen_internal(params)
+    body = (json.dumps(result) + '\n').encode('utf-8')
+    return respond(start_response, '200 OK', body)
+
+
+# Load the tables as soon as the server imports us.
+try:
+    webgen.warm_up()
+except Exception:
+    # Let the first request try again, and report the problem then.
+    pass
+
+
+# Main Function
+if __name__ == '__main__':
+    # Serve locally, for testing.
+    from wsgiref.simple_server import make_server
+
+    port = 8000
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    server = make_server('', port, application)
+    print('Serving on port', port)
+    server.serve_forever()
@@ -26,14 +26,24 @@ This module is the web interface for item generation.
 
 from __future__ import print_function
 
+import hashlib
+import io
 import json
 import os
 import os.path
 import select
 import sqlite3 as sqlite
 import sys
+import threading
 import time
 import traceback
+from email.utils import formatdate, mktime_tz, parsedate_tz
+
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    # Python 2
+    from urlparse import parse_qsl
 
 
 #
@@ -54,6 +64,26 @@ LOCAL = True
 
 DEBUG = True
 
+# Directory holding the databases, relative to the working directory unless
+# set otherwise.
+DATA_DIR = 'data'
+
+# Whether to keep database connections open between requests.  A CGI process
+# serves one request, so it doesn't; a long-lived server (see webapp.py) does.
+KEEP_CONNECTIONS = False
+
+# Per-thread cache of open connections, by file name, when they are kept.
+CONNECTIONS = threading.local()
+
+# File in the data directory holding the precomputed answers to hoard_types
+# and hoard_budget requests, written by initdb.py.
+PAYLOAD_FILE = 'hoard.json'
+
+# The precomputed answers, once loaded, and when they were written, as an
+# HTTP date.
+PAYLOADS = None
+PAYLOADS_MODIFIED = None
+
 
 #
 # Execution
@@ -67,14 +97,191 @@ def default_get(d, k, val):
     return d[k]
 
 
+def get_budget(conn, params):
+    '''Calculates a hoard budget from the parameters of a 'hoard_budget'
+    request.'''
+    if params['type'] == 'custom':
+        return hoard.calculate_budget_custom(conn, params['custom_gp'])
+    elif params['type'] == 'encounter':
+        apl = params['apl']
+        rate = params['rate']
+        magnitude = params['magnitude']
+        return hoard.calculate_budget_encounter(conn, apl, rate, magnitude)
+    elif params['type'] == 'npc_gear':
+        npc_level = params['npc_level']
+        is_heroic = default_get(params, 'heroic', "false") == "true"
+        return hoard.calculate_budget_npc_gear(conn, npc_level, is_heroic)
+    return {}
+
+
+def get_treasure_types(params):
+    '''Returns the letters of the treasure types selected by the 'type_a'
+    through 'type_i' parameters.'''
+    types = ''
+    for tt in 'abcdefghi':
+        if default_get(params, 'type_' + tt, 'false') == 'true': types += tt
+    return types
+
+
+def open_database(filename):
+    '''Opens a database in the data directory, or reuses this thread's open
+    connection to it if connections are being kept.'''
+    if KEEP_CONNECTIONS:
+        cache = CONNECTIONS.__dict__
+        if filename in cache:
+            return cache[filename]
+    conn = item.connect_read_only(os.path.join(DATA_DIR, filename))
+    if KEEP_CONNECTIONS:
+        cache[filename] = conn
+    return conn
+
+
+def open_frequencies():
+    '''Opens the frequency database, or returns None if there isn't one.'''
+    if not os.path.isfile(os.path.join(DATA_DIR, 'freq.db')):
+        return None
+    return open_database('freq.db')
+
+
+def warm_up():
+    '''Loads the roll tables, the frequency tables and the precomputed
+    answers, if there are any, ahead of the first request.'''
+    load_payloads()
+    for (filename, store) in [('data.db', item.TABLE_STORE),
+            ('freq.db', item.FREQUENCY_STORE)]:
+        if store.is_loaded():
+            continue
+        if not os.path.isfile(os.path.join(DATA_DIR, filename)):
+            continue
+        conn = open_database(filename)
+        try:
+            store.load(conn)
+        finally:
+            if not KEEP_CONNECTIONS:
+                conn.close()
+
+
+def get_query_params(query):
+    '''Returns the parameters of a GET request's query string, in the form
+    of a JSON request.'''
+    return dict(parse_qsl(query))
+
+
+def load_payloads():
+    '''Loads the precomputed answers, if they haven't been loaded yet.
+    Returns them, or None if initdb.py didn't write any.'''
+    global PAYLOADS, PAYLOADS_MODIFIED
+    if PAYLOADS is None:
+        filename = os.path.join(DATA_DIR, PAYLOAD_FILE)
+        if not os.path.isfile(filename):
+            return None
+        with io.open(filename, encoding='utf-8') as f:
+            payloads = json.load(f)
+        PAYLOADS_MODIFIED = formatdate(os.path.getmtime(filename),
+                usegmt=True)
+        PAYLOADS = payloads
+    return PAYLOADS
+
+
+def get_static_result(params):
+    '''Answers a hoard_types or hoard_budget request from the precomputed
+    answers, without opening the database.  Returns None if it can't.'''
+    mode = params.get('mode')
+    if mode not in ['hoard_types', 'hoard_budget']:
+        return None
+    payloads = load_payloads()
+    if payloads is None:
+        return None
+    try:
+        if mode == 'hoard_types':
+            tables = payloads['hoard_types']
+            return dict((tt, tables[tt]) for tt in get_treasure_types(params))
+        budgets = payloads['hoard_budget']
+        if params['type'] == 'custom':
+            # This one is only arithmetic.
+            return hoard.calculate_budget_custom(None, params['custom_gp'])
+        elif params['type'] == 'encounter':
+            return budgets['encounter'][str(params['apl'])][
+                    params['rate']][params['magnitude']]
+        elif params['type'] == 'npc_gear':
+            level = int(params['npc_level'])
+            if default_get(params, 'heroic', "false") == "true": level += 1
+            return budgets['npc_gear'][str(level)]
+    except (KeyError, TypeError, ValueError):
+        pass
+    # Leave anything unusual to the database.
+    return None
+
+
+def get_static_response(params):
+    '''Returns the JSON text, ETag and Last-Modified date of a response made
+    from the precomputed answers, or None if there isn't one.'''
+    result = get_static_result(params)
+    if result is None:
+        return None
+    # Sorted, so every process gives the same text, and the same ETag.
+    body = json.dumps(result, sort_keys=True)
+    etag = '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+    return (body, etag, PAYLOADS_MODIFIED)
+
+
+def is_not_modified(environ, etag, modified):
+    '''Whether a GET request's If-None-Match or If-Modified-Since header
+    shows that the client already has the response.'''
+    if environ.get('REQUEST_METHOD', 'GET') not in ['GET', 'HEAD']:
+        return False
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    since = parsedate_tz(environ.get('HTTP_IF_MODIFIED_SINCE') or '')
+    if since is not None:
+        return mktime_tz(since) >= mktime_tz(parsedate_tz(modified))
+    return False
+
+
+def output_static(static, environ, f):
+    '''Writes a response made from the precomputed answers, or a 304 if the
+    client already has it.'''
+    (body, etag, modified) = static
+    headers = ['ETag: ' + etag, 'Last-Modified: ' + modified,
+            'Cache-Control: no-cache']
+    if is_not_modified(environ, etag, modified):
+        print('Status: 304 Not Modified', file=f)
+        print('\n'.join(headers) + '\n', file=f)
+        return
+    print('Content-Type: application/json; charset=UTF-8', file=f)
+    print('\n'.join(headers) + '\n', file=f)
+    print(body, file=f)
+
+
 def output_json(result, f):
     print('Content-Type: application/json; charset=UTF-8\n', file=f)
     print(json.dumps(result), file=f)
 
-def run_webgen(params):
+def output_ndjson(chunks, f):
+    '''Writes each chunk as a line of JSON as soon as it is ready.'''
+    print('Content-Type: application/x-ndjson; charset=UTF-8\n', file=f)
+    f.flush()
+    for chunk in chunks:
+        print(json.dumps(chunk), file=f)
+        f.flush()
+
+def run_webgen(params, environ=None):
     # Set output file descriptor.
     out = sys.stdout
 
+    # Stream the result, if asked.
+    if params.get('stream', '') == 'true':
+        output_ndjson(iterate_webgen(params), out)
+        return
+
+    # Answer from memory, if possible.
+    static = get_static_response(params)
+    if static is not None:
+        output_static(static, environ or {}, out)
+        return
+
     # Obtain the result.
     result = run_webgen_internal(params);
 
@@ -91,6 +298,7 @@ def run_webgen_internal(params):
 
 
     conn = None
+    freq_conn = None
     result = "Error: unspecified program error"
     try:
         # Mode of operation:
@@ -105,14 +313,18 @@ def run_webgen_internal(params):
 
         elif mode == 'settlement':
             # Open the database.
-            conn = sqlite.connect('data/data.db')
-            conn.row_factory = sqlite.Row
+            conn = open_database('data.db')
+
+            freq_conn = open_frequencies()
 
             settlement_size = params.get('size','Thorp')
             options = {
-                    'list_rolls' : list_rolls
+                    'list_rolls' : list_rolls,
+                    'freq_conn' : freq_conn
                     }
-            roller = rollers.PseudorandomRoller()
+            # Only keep a roll log if it will be sent back.
+            roller = rollers.PseudorandomRoller(
+                    log_rolls=(list_rolls == 'true'))
             result = settlements.generate_settlement_items(conn,
                     settlement_size, roller, **options)
             if list_rolls == 'true':
@@ -121,8 +333,7 @@ def run_webgen_internal(params):
 
         elif mode == 'custom':
             # Open the database.
-            conn = sqlite.connect('data/freq.db')
-            conn.row_factory = sqlite.Row
+            freq_conn = open_frequencies()
 
             base_value = default_get(params, 'base_value', 0)
             q_ls_min = default_get(params, 'q_ls_min', '1')
@@ -131,69 +342,67 @@ def run_webgen_internal(params):
             q_gt_med = default_get(params, 'q_gt_med', '1')
             q_ls_maj = default_get(params, 'q_ls_maj', '1')
             q_gt_maj = default_get(params, 'q_gt_maj', '1')
-            result = settlements.generate_custom(conn,
-                    rollers.PseudorandomRoller(),
-                    base_value, q_ls_min, q_gt_min, q_ls_med, q_gt_med,
-                    q_ls_maj, q_gt_maj)
+            if freq_conn is None:
+                result = 'Error: custom settlements need the frequency ' + \
+                        'database'
+            else:
+                result = settlements.generate_custom(freq_conn,
+                        rollers.PseudorandomRoller(log_rolls=False),
+                        base_value, q_ls_min, q_gt_min, q_ls_med, q_gt_med,
+                        q_ls_maj, q_gt_maj)
 
         elif mode == 'individual':
             # Open the database.
-            conn = sqlite.connect('data/data.db')
-            conn.row_factory = sqlite.Row
+            conn = open_database('data.db')
 
             strength = params['strength']
             kind = params['type']
             result = item.generate_item(conn, strength + ' ' + kind,
-                    rollers.PseudorandomRoller(), None)
+                    rollers.PseudorandomRoller(log_rolls=False), None)
             # In this case, item is an Item object.
-            result = unicode(result)
+            result = item.text_type(result)
 
         elif mode == 'hoard_budget':
-            # Open the database.
-            conn = sqlite.connect('data/data.db')
-            conn.row_factory = sqlite.Row
-
-            if params['type'] == 'custom':
-                result = hoard.calculate_budget_custom(conn, params['custom_gp'])
-            elif params['type'] == 'encounter':
-                apl = params['apl']
-                rate = params['rate']
-                magnitude = params['magnitude']
-                result = hoard.calculate_budget_encounter(conn, apl, rate, magnitude)
-            elif params['type'] == 'npc_gear':
-                npc_level = params['npc_level']
-                is_heroic = default_get(params, 'heroic', "false") == "true"
-                result = hoard.calculate_budget_npc_gear(conn, npc_level, is_heroic)
-            else:
-                result = {}
-        
+            result = get_static_result(params)
+            if result is None:
+                # Open the database.
+                conn = open_database('data.db')
+
+                result = get_budget(conn, params)
+
         elif mode == 'hoard_types':
-            # Open the database.
-            conn = sqlite.connect('data/data.db')
-            conn.row_factory = sqlite.Row
-
-            types = ''
-            if default_get(params, 'type_a', 'false') == 'true': types += 'a'
-            if default_get(params, 'type_b', 'false') == 'true': types += 'b'
-            if default_get(params, 'type_c', 'false') == 'true': types += 'c'
-            if default_get(params, 'type_d', 'false') == 'true': types += 'd'
-            if default_get(params, 'type_e', 'false') == 'true': types += 'e'
-            if default_get(params, 'type_f', 'false') == 'true': types += 'f'
-            if default_get(params, 'type_g', 'false') == 'true': types += 'g'
-            if default_get(params, 'type_h', 'false') == 'true': types += 'h'
-            if default_get(params, 'type_i', 'false') == 'true': types += 'i'
-            result = hoard.get_treasure_list(conn, types)
+            result = get_static_result(params)
+            if result is None:
+                # Open the database.
+                conn = open_database('data.db')
+
+                types = get_treasure_types(params)
+                result = hoard.get_treasure_list(conn, types)
 
         elif mode == 'hoard_generate':
             # Open the database.
-            conn = sqlite.connect('data/data.db')
-            conn.row_factory = sqlite.Row
+            conn = open_database('data.db')
 
             # This one is so complex, it only operates via a map. It'll ignore
             # the transmission-related keys in the dict, e.g. "mode". So we
             # can simple pass the param dict to the function.
             result = hoard.generate_treasure(conn, params,
-                    rollers.PseudorandomRoller(), None)
+                    rollers.PseudorandomRoller(log_rolls=False), None)
+
+        elif mode == 'hoard_fit':
+            # Open the database.
+            conn = open_database('data.db')
+
+            # Work out the budget and the treasure types as the two requests
+            # above would, and spend the budget on the rows of those types.
+            budget = get_budget(conn, params).get('as_int', 0)
+            types = get_treasure_types(params)
+            if budget > hoard.MAX_FIT_BUDGET:
+                result = 'Error: cannot fit a budget over {0:,} gp'.format(
+                        hoard.MAX_FIT_BUDGET)
+            else:
+                result = hoard.generate_fitted_treasure(conn, budget, types,
+                        rollers.PseudorandomRoller(log_rolls=False), None)
 
         else:
             result = "Error: invalid mode value"
@@ -207,12 +416,71 @@ def run_webgen_internal(params):
             traceback.print_exc(file=sys.stderr)
 
     finally:
-        if conn:
+        if conn and not KEEP_CONNECTIONS:
             conn.close()
+        if freq_conn and not KEEP_CONNECTIONS:
+            freq_conn.close()
 
     return result
 
 
+def iterate_webgen(params):
+    '''Like run_webgen_internal, but yields the result in chunks as it is
+    generated.  A settlement yields its details, then one chunk per item,
+    each naming its list in 'group', then its rolls, if listed.  A hoard
+    yields each of its result strings, with a far higher limit on the number
+    of lots (see hoard.MAX_STREAMED_TREASURE_LOTS).
+    Other modes yield their whole result as one chunk.'''
+
+    mode = params.get('mode')
+    if mode not in ['settlement', 'hoard_generate']:
+        yield run_webgen_internal(params)
+        return
+
+    conn = None
+    freq_conn = None
+    try:
+        # Open the database.
+        conn = open_database('data.db')
+
+        if mode == 'settlement':
+            freq_conn = open_frequencies()
+
+            list_rolls = params.get('list_rolls', '')
+            options = {
+                    'list_rolls' : list_rolls,
+                    'freq_conn' : freq_conn
+                    }
+            roller = rollers.PseudorandomRoller(
+                    log_rolls=(list_rolls == 'true'))
+            for (group, x) in settlements.iter_settlement_items(conn,
+                    params.get('size','Thorp'), roller, **options):
+                if group is not None:
+                    x['group'] = group
+                yield x
+            if list_rolls == 'true':
+                yield {'rolls': roller.get_log(),
+                        'roll_count': roller.get_rollcount()}
+
+        else:
+            for x in hoard.iter_treasure(conn, params,
+                    rollers.PseudorandomRoller(log_rolls=False), None,
+                    hoard.MAX_STREAMED_TREASURE_LOTS):
+                yield x
+
+    except Exception:
+        # Not a bare except: closing the generator must still work.
+        if DEBUG:
+            traceback.print_exc(file=sys.stderr)
+        yield "Error: unspecified program error"
+
+    finally:
+        if conn and not KEEP_CONNECTIONS:
+            conn.close()
+        if freq_conn and not KEEP_CONNECTIONS:
+            freq_conn.close()
+
+
 # Main Function
 if __name__ == '__main__':
 
@@ -231,12 +499,16 @@ if __name__ == '__main__':
         # already run from the cgi-bin directory.
         os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
-    # Access the CGI form.
-    params = json.load(sys.stdin)
+    # Access the CGI form: JSON, or a query string for requests that can be
+    # cached.
+    if os.environ.get('REQUEST_METHOD') == 'GET':
+        params = get_query_params(os.environ.get('QUERY_STRING', ''))
+    else:
+        params = json.load(sys.stdin)
 
     log = open('log.txt', 'w+')
     print(params, file=log)
     log.close()
 
-    run_webgen(params)
+    run_webgen(params, os.environ)
 
@@ -21,12 +21,133 @@ database with the information contained within.
 # Standard imports
 
 import argparse
-import codecs
 import getpass
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import shutil
 import sqlite3 as sqlite
 import sys
 
+#
+# Local imports
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'cgi-bin', 'pf_items'))
+import hoard
+import item
+
+
+#
+# Constants
+
+# File, next to the database, holding the precomputed answers to requests
+# that only depend on the data (see webgen.py).
+PAYLOAD_FILE = 'hoard.json'
+
+# Table recording the file each table was built from, the file's hash, and
+# its metadata line, so that later builds only reload the tables whose files
+# have changed.
+SOURCES_TABLE = item.DATA_SOURCES_TABLE
+
+# Suffix of the files built beside the live ones, and swapped into place once
+# they are complete.
+TEMP_SUFFIX = '.tmp'
+
+# Dashes that can separate the ends of a range: hyphen, en dash (hex 2013),
+# and em dash (hex 2014).
+RANGE_DASHES = {0x2013: '-', 0x2014: '-'}
+
+# Tables to build, and the files they are built from.
+TABLES = [
+        ('Settlements',                     'data_src/Settlements'),
+        ('Item_Types',                      'data_src/Item_Types'),
+        ('Magic_Armor_and_Shields',         'data_src/ue/Magic_Armor_and_Shields'),
+        ('Magic_Weapons',                   'data_src/ue/Magic_Weapons'),
+        ('Metamagic_Rods_1',                'data_src/ue/Metamagic_Rods_1'),
+        ('Metamagic_Rods_2',                'data_src/ue/Metamagic_Rods_2'),
+        ('Metamagic_Rods_3',                'data_src/ue/Metamagic_Rods_3'),
+        ('Potion_or_Oil_Level_0',           'data_src/ue/Potion_or_Oil_Level_0'),
+        ('Potion_or_Oil_Level_1',           'data_src/ue/Potion_or_Oil_Level_1'),
+        ('Potion_or_Oil_Level_2',           'data_src/ue/Potion_or_Oil_Level_2'),
+        ('Potion_or_Oil_Level_3',           'data_src/ue/Potion_or_Oil_Level_3'),
+        ('Potion_or_Oil_Type',              'data_src/ue/Potion_or_Oil_Type'),
+        ('Random_Armor_or_Shield',          'data_src/ue/Random_Armor_or_Shield'),
+        ('Random_Art_Objects',              'data_src/ue/Random_Art_Objects'),
+        ('Random_Gems',                     'data_src/ue/Random_Gems'),
+        ('Random_Potions_and_Oils',         'data_src/ue/Random_Potions_and_Oils'),
+        ('Random_Scrolls',                  'data_src/ue/Random_Scrolls'),
+        ('Random_Wands',                    'data_src/ue/Random_Wands'),
+        ('Random_Weapon',                   'data_src/ue/Random_Weapon'),
+        ('Rings',                           'data_src/ue/Rings'),
+        ('Rods',                            'data_src/ue/Rods'),
+        ('Scrolls_Arcane_Level_0',          'data_src/ue/Scrolls_Arcane_Level_0'),
+        ('Scrolls_Arcane_Level_1',          'data_src/ue/Scrolls_Arcane_Level_1'),
+        ('Scrolls_Arcane_Level_2',          'data_src/ue/Scrolls_Arcane_Level_2'),
+        ('Scrolls_Arcane_Level_3',          'data_src/ue/Scrolls_Arcane_Level_3'),
+        ('Scrolls_Arcane_Level_4',          'data_src/ue/Scrolls_Arcane_Level_4'),
+        ('Scrolls_Arcane_Level_5',          'data_src/ue/Scrolls_Arcane_Level_5'),
+        ('Scrolls_Arcane_Level_6',          'data_src/ue/Scrolls_Arcane_Level_6'),
+        ('Scrolls_Arcane_Level_7',          'data_src/ue/Scrolls_Arcane_Level_7'),
+        ('Scrolls_Arcane_Level_8',          'data_src/ue/Scrolls_Arcane_Level_8'),
+        ('Scrolls_Arcane_Level_9',          'data_src/ue/Scrolls_Arcane_Level_9'),
+        ('Scrolls_Divine_Level_0',          'data_src/ue/Scrolls_Divine_Level_0'),
+        ('Scrolls_Divine_Level_1',          'data_src/ue/Scrolls_Divine_Level_1'),
+        ('Scrolls_Divine_Level_2',          'data_src/ue/Scrolls_Divine_Level_2'),
+        ('Scrolls_Divine_Level_3',          'data_src/ue/Scrolls_Divine_Level_3'),
+        ('Scrolls_Divine_Level_4',          'data_src/ue/Scrolls_Divine_Level_4'),
+        ('Scrolls_Divine_Level_5',          'data_src/ue/Scrolls_Divine_Level_5'),
+        ('Scrolls_Divine_Level_6',          'data_src/ue/Scrolls_Divine_Level_6'),
+        ('Scrolls_Divine_Level_7',          'data_src/ue/Scrolls_Divine_Level_7'),
+        ('Scrolls_Divine_Level_8',          'data_src/ue/Scrolls_Divine_Level_8'),
+        ('Scrolls_Divine_Level_9',          'data_src/ue/Scrolls_Divine_Level_9'),
+        ('Scroll_Type',                     'data_src/ue/Scroll_Type'),
+        ('Special_Abilities_Ammunition',    'data_src/ue/Special_Abilities_Ammunition'),
+        ('Special_Abilities_Armor',         'data_src/ue/Special_Abilities_Armor'),
+        ('Special_Abilities_Melee_Weapon',  'data_src/ue/Special_Abilities_Melee_Weapon'),
+        ('Special_Abilities_Ranged_Weapon', 'data_src/ue/Special_Abilities_Ranged_Weapon'),
+        ('Special_Abilities_Shield',        'data_src/ue/Special_Abilities_Shield'),
+        ('Special_Bane',                    'data_src/ue/Special_Bane'),
+        ('Special_Slaying_Arrow',           'data_src/ue/Special_Slaying_Arrow'),
+        ('Specific_Armor',                  'data_src/ue/Specific_Armor'),
+        ('Specific_Cursed_Items',           'data_src/ue/Specific_Cursed_Items'),
+        ('Specific_Shields',                'data_src/ue/Specific_Shields'),
+        ('Specific_Weapons',                'data_src/ue/Specific_Weapons'),
+        ('Staves',                          'data_src/ue/Staves'),
+        ('Wand_Level_0',                    'data_src/ue/Wand_Level_0'),
+        ('Wand_Level_1',                    'data_src/ue/Wand_Level_1'),
+        ('Wand_Level_2',                    'data_src/ue/Wand_Level_2'),
+        ('Wand_Level_3',                    'data_src/ue/Wand_Level_3'),
+        ('Wand_Level_4',                    'data_src/ue/Wand_Level_4'),
+        ('Wand_Type',                       'data_src/ue/Wand_Type'),
+        ('Wondrous_Items',                  'data_src/ue/Wondrous_Items'),
+        ('Wondrous_Items_Belt',             'data_src/ue/Wondrous_Items_Belt'),
+        ('Wondrous_Items_Body',             'data_src/ue/Wondrous_Items_Body'),
+        ('Wondrous_Items_Chest',            'data_src/ue/Wondrous_Items_Chest'),
+        ('Wondrous_Items_Eyes',             'data_src/ue/Wondrous_Items_Eyes'),
+        ('Wondrous_Items_Feet',             'data_src/ue/Wondrous_Items_Feet'),
+        ('Wondrous_Items_Hands',            'data_src/ue/Wondrous_Items_Hands'),
+        ('Wondrous_Items_Head',             'data_src/ue/Wondrous_Items_Head'),
+        ('Wondrous_Items_Headband',         'data_src/ue/Wondrous_Items_Headband'),
+        ('Wondrous_Items_Neck',             'data_src/ue/Wondrous_Items_Neck'),
+        ('Wondrous_Items_Shoulders',        'data_src/ue/Wondrous_Items_Shoulders'),
+        ('Wondrous_Items_Slotless',         'data_src/ue/Wondrous_Items_Slotless'),
+        ('Wondrous_Items_Wrists',           'data_src/ue/Wondrous_Items_Wrists'),
+        ('Treasure_Values_Per_Encounter',   'data_src/ue/Treasure_Values_Per_Encounter'),
+        ('NPC_Gear',                        'data_src/ue/NPC_Gear'),
+        ('Type_A_Treasure',                 'data_src/ue/Type_A_Treasure'),
+        ('Type_B_Treasure',                 'data_src/ue/Type_B_Treasure'),
+        ('Type_C_Treasure',                 'data_src/ue/Type_C_Treasure'),
+        ('Type_D_Treasure',                 'data_src/ue/Type_D_Treasure'),
+        ('Type_E_Treasure',                 'data_src/ue/Type_E_Treasure'),
+        ('Type_F_Treasure',                 'data_src/ue/Type_F_Treasure'),
+        ('Type_G_Treasure',                 'data_src/ue/Type_G_Treasure'),
+        ('Type_H_Treasure',                 'data_src/ue/Type_H_Treasure'),
+        ('Type_I_Treasure',                 'data_src/ue/Type_I_Treasure'),
+        ]
+
 
 #
 # Classes
@@ -60,28 +181,27 @@ class Table(object):
         self.rows = []
         self.sql_create = None
         self.sql_inserts = None
+        self.sql_indexes = []
         # Setup the table commands.
         self.read()
         self.process()
 
     def read(self):
-        # Open the file, of course.
-        f = codecs.open(self.filename, encoding='utf-8')
+        # Read the whole file at once, of course.
+        with io.open(self.filename, encoding='utf-8', newline='') as f:
+            lines = f.read().splitlines()
         # Non-comment line number, for tracking what kind of line to expect.
         lineno = 0
         # Actual line number, for error reporting.
         reallineno = 0
         # Iterate over the lines of the table, ignoring comment lines.
-        for line in f:
+        for line in lines:
             # Ignore comment lines, and they should not increment 'lineno'.
             if line.startswith('#'):
                 # We do want to increment the absolute line number, though.
                 reallineno += 1
                 continue
             # Split the line into parts (tab delimited file)
-            line = line[:-1]
-            if line.endswith('\r'): line = line[:-1]
-            # TODO can this be handled more elegantly?
             data = line.split('\t')
 
             # Depending on the ordinality of non-comment lines, assign.
@@ -129,6 +249,14 @@ class Table(object):
             if col_type == 'range':
                 parts.append('"{0}_low" int'.format(col_name))
                 parts.append('"{0}_high" int'.format(col_name))
+                # Rolls are looked up by range, within a strength.
+                keys = ['"{0}_low"'.format(col_name),
+                        '"{0}_high"'.format(col_name)]
+                if 'Strength' in self.columns:
+                    keys.insert(0, '"Strength"')
+                self.sql_indexes.append(
+                        'CREATE INDEX "{0}_{1}" ON {0} ({2});'.format(
+                            self.tablename, col_name, ', '.join(keys)))
             else:
                 parts.append('"{0}" {1}'.format(col_name.strip(), col_type)) 
         # Bind variables/substitutions works with known quantities.
@@ -163,25 +291,20 @@ class Table(object):
     def get_sql_inserts(self):
         return self.sql_inserts
 
+    def get_sql_indexes(self):
+        return self.sql_indexes
+
 #
 # Functions
 
 def split_range(range_str):
-    span = (0,0)
-    if '-' in range_str:
-        span = tuple(range_str.split('-'))
-    elif '–' in range_str:
-        # Note: the character mentioned here is hex 2013, not a simple dash
-        span = tuple(range_str.split('–'))
-    elif '—' in range_str:
-        # Note: the character mentioned here is hex 2014, not a simple dash
-        span = tuple(range_str.split('—'))
-    else:
-        span = (range_str, range_str)
-    return (int(span[0]), int(span[1]))
+    (low, dash, high) = range_str.translate(RANGE_DASHES).partition('-')
+    if not dash:
+        return (int(low), int(low))
+    return (int(low), int(high))
 
 
-def build_table(cursor, tablename, filename):
+def parse_table(source):
     # File format:
     # * Any line that starts with '#' is a comment.
     # The first non-comment line is metadata, which should go in a
@@ -193,155 +316,233 @@ def build_table(cursor, tablename, filename):
     # name, and the resulting columns are then INT.  When using a string
     # column, we must first determine the longest string so we can set the
     # length of the VARCHAR.  int corresponds with the INT type, I believe.
-    t = Table(tablename, filename)
+    (tablename, filename) = source
+    return Table(tablename, filename)
+
+
+def load_table(cursor, t):
+    '''Loads a parsed table, returning whether it was.  An error loading it
+    is raised, which abandons the whole build.'''
     sql_create = t.get_sql_create()
     sql_inserts = t.get_sql_inserts()
-    if sql_create:
-        print('Creating table ' + tablename)
-        try:
-            # SQL Create
-            if len(sql_create) == 1:
-                cursor.execute(sql_create[0])
-            else:
-                cursor.execute(sql_create[0], sql_create[1])
-            # SQL Insert
-            cursor.executemany(sql_inserts[0], sql_inserts[1])
-        except sqlite.Error as e:
-            print('Error:', e.message)
+    if not sql_create:
+        print('Skipping table ' + t.tablename + ' due to null SQL')
+        return False
+    print('Creating table ' + t.tablename)
+    # SQL Create
+    if len(sql_create) == 1:
+        cursor.execute(sql_create[0])
     else:
-        print('Skipping table ' + tablename + ' due to null SQL')
-
-
-def build_tables(cursor):
-    tables = [ 
-            ('Settlements',                     'data_src/Settlements'),
-            ('Item_Types',                      'data_src/Item_Types'),
-            ('Magic_Armor_and_Shields',         'data_src/ue/Magic_Armor_and_Shields'),
-            ('Magic_Weapons',                   'data_src/ue/Magic_Weapons'),
-            ('Metamagic_Rods_1',                'data_src/ue/Metamagic_Rods_1'),
-            ('Metamagic_Rods_2',                'data_src/ue/Metamagic_Rods_2'),
-            ('Metamagic_Rods_3',                'data_src/ue/Metamagic_Rods_3'),
-            ('Potion_or_Oil_Level_0',           'data_src/ue/Potion_or_Oil_Level_0'),
-            ('Potion_or_Oil_Level_1',           'data_src/ue/Potion_or_Oil_Level_1'),
-            ('Potion_or_Oil_Level_2',           'data_src/ue/Potion_or_Oil_Level_2'),
-            ('Potion_or_Oil_Level_3',           'data_src/ue/Potion_or_Oil_Level_3'),
-            ('Potion_or_Oil_Type',              'data_src/ue/Potion_or_Oil_Type'),
-            ('Random_Armor_or_Shield',          'data_src/ue/Random_Armor_or_Shield'),
-            ('Random_Art_Objects',              'data_src/ue/Random_Art_Objects'),
-            ('Random_Gems',                     'data_src/ue/Random_Gems'),
-            ('Random_Potions_and_Oils',         'data_src/ue/Random_Potions_and_Oils'),
-            ('Random_Scrolls',                  'data_src/ue/Random_Scrolls'),
-            ('Random_Wands',                    'data_src/ue/Random_Wands'),
-            ('Random_Weapon',                   'data_src/ue/Random_Weapon'),
-            ('Rings',                           'data_src/ue/Rings'),
-            ('Rods',                            'data_src/ue/Rods'),
-            ('Scrolls_Arcane_Level_0',          'data_src/ue/Scrolls_Arcane_Level_0'),
-            ('Scrolls_Arcane_Level_1',          'data_src/ue/Scrolls_Arcane_Level_1'),
-            ('Scrolls_Arcane_Level_2',          'data_src/ue/Scrolls_Arcane_Level_2'),
-            ('Scrolls_Arcane_Level_3',          'data_src/ue/Scrolls_Arcane_Level_3'),
-            ('Scrolls_Arcane_Level_4',          'data_src/ue/Scrolls_Arcane_Level_4'),
-            ('Scrolls_Arcane_Level_5',          'data_src/ue/Scrolls_Arcane_Level_5'),
-            ('Scrolls_Arcane_Level_6',          'data_src/ue/Scrolls_Arcane_Level_6'),
-            ('Scrolls_Arcane_Level_7',          'data_src/ue/Scrolls_Arcane_Level_7'),
-            ('Scrolls_Arcane_Level_8',          'data_src/ue/Scrolls_Arcane_Level_8'),
-            ('Scrolls_Arcane_Level_9',          'data_src/ue/Scrolls_Arcane_Level_9'),
-            ('Scrolls_Divine_Level_0',          'data_src/ue/Scrolls_Divine_Level_0'),
-            ('Scrolls_Divine_Level_1',          'data_src/ue/Scrolls_Divine_Level_1'),
-            ('Scrolls_Divine_Level_2',          'data_src/ue/Scrolls_Divine_Level_2'),
-            ('Scrolls_Divine_Level_3',          'data_src/ue/Scrolls_Divine_Level_3'),
-            ('Scrolls_Divine_Level_4',          'data_src/ue/Scrolls_Divine_Level_4'),
-            ('Scrolls_Divine_Level_5',          'data_src/ue/Scrolls_Divine_Level_5'),
-            ('Scrolls_Divine_Level_6',          'data_src/ue/Scrolls_Divine_Level_6'),
-            ('Scrolls_Divine_Level_7',          'data_src/ue/Scrolls_Divine_Level_7'),
-            ('Scrolls_Divine_Level_8',          'data_src/ue/Scrolls_Divine_Level_8'),
-            ('Scrolls_Divine_Level_9',          'data_src/ue/Scrolls_Divine_Level_9'),
-            ('Scroll_Type',                     'data_src/ue/Scroll_Type'),
-            ('Special_Abilities_Ammunition',    'data_src/ue/Special_Abilities_Ammunition'),
-            ('Special_Abilities_Armor',         'data_src/ue/Special_Abilities_Armor'),
-            ('Special_Abilities_Melee_Weapon',  'data_src/ue/Special_Abilities_Melee_Weapon'),
-            ('Special_Abilities_Ranged_Weapon', 'data_src/ue/Special_Abilities_Ranged_Weapon'),
-            ('Special_Abilities_Shield',        'data_src/ue/Special_Abilities_Shield'),
-            ('Special_Bane',                    'data_src/ue/Special_Bane'),
-            ('Special_Slaying_Arrow',           'data_src/ue/Special_Slaying_Arrow'),
-            ('Specific_Armor',                  'data_src/ue/Specific_Armor'),
-            ('Specific_Cursed_Items',           'data_src/ue/Specific_Cursed_Items'),
-            ('Specific_Shields',                'data_src/ue/Specific_Shields'),
-            ('Specific_Weapons',                'data_src/ue/Specific_Weapons'),
-            ('Staves',                          'data_src/ue/Staves'),
-            ('Wand_Level_0',                    'data_src/ue/Wand_Level_0'),
-            ('Wand_Level_1',                    'data_src/ue/Wand_Level_1'),
-            ('Wand_Level_2',                    'data_src/ue/Wand_Level_2'),
-            ('Wand_Level_3',                    'data_src/ue/Wand_Level_3'),
-            ('Wand_Level_4',                    'data_src/ue/Wand_Level_4'),
-            ('Wand_Type',                       'data_src/ue/Wand_Type'),
-            ('Wondrous_Items',                  'data_src/ue/Wondrous_Items'),
-            ('Wondrous_Items_Belt',             'data_src/ue/Wondrous_Items_Belt'),
-            ('Wondrous_Items_Body',             'data_src/ue/Wondrous_Items_Body'),
-            ('Wondrous_Items_Chest',            'data_src/ue/Wondrous_Items_Chest'),
-            ('Wondrous_Items_Eyes',             'data_src/ue/Wondrous_Items_Eyes'),
-            ('Wondrous_Items_Feet',             'data_src/ue/Wondrous_Items_Feet'),
-            ('Wondrous_Items_Hands',            'data_src/ue/Wondrous_Items_Hands'),
-            ('Wondrous_Items_Head',             'data_src/ue/Wondrous_Items_Head'),
-            ('Wondrous_Items_Headband',         'data_src/ue/Wondrous_Items_Headband'),
-            ('Wondrous_Items_Neck',             'data_src/ue/Wondrous_Items_Neck'),
-            ('Wondrous_Items_Shoulders',        'data_src/ue/Wondrous_Items_Shoulders'),
-            ('Wondrous_Items_Slotless',         'data_src/ue/Wondrous_Items_Slotless'),
-            ('Wondrous_Items_Wrists',           'data_src/ue/Wondrous_Items_Wrists'),
-            ('Treasure_Values_Per_Encounter',   'data_src/ue/Treasure_Values_Per_Encounter'),
-            ('NPC_Gear',                        'data_src/ue/NPC_Gear'),
-            ('Type_A_Treasure',                 'data_src/ue/Type_A_Treasure'),
-            ('Type_B_Treasure',                 'data_src/ue/Type_B_Treasure'),
-            ('Type_C_Treasure',                 'data_src/ue/Type_C_Treasure'),
-            ('Type_D_Treasure',                 'data_src/ue/Type_D_Treasure'),
-            ('Type_E_Treasure',                 'data_src/ue/Type_E_Treasure'),
-            ('Type_F_Treasure',                 'data_src/ue/Type_F_Treasure'),
-            ('Type_G_Treasure',                 'data_src/ue/Type_G_Treasure'),
-            ('Type_H_Treasure',                 'data_src/ue/Type_H_Treasure'),
-            ('Type_I_Treasure',                 'data_src/ue/Type_I_Treasure'),
-            ]
-
-    for (table_name, table_file) in tables:
-        build_table(cursor, table_name, table_file)
-
-
-def initialize_database(database):
-    try:
-        # Open a connection
-        con = None
+        cursor.execute(sql_create[0], sql_create[1])
+    # SQL Insert
+    cursor.executemany(sql_inserts[0], sql_inserts[1])
+    # SQL Index, once the rows are in
+    for sql_index in t.get_sql_indexes():
+        cursor.execute(sql_index)
+    return True
 
-        # We're starting over, so erase the file.
-        if os.path.isfile(database):
-            os.remove(database)
-        # Open the database file.
-        con = sqlite.connect(database)
 
-    for (table_name, table_file) in tables:
-        build_table(cursor, table_name, table_file)
+def build_table(cursor, tablename, filename):
+    load_table(cursor, parse_table((tablename, filename)))
 
 
-def initialize_database(database):
+def build_tables(cursor, tables=TABLES, jobs=None):
+    '''Builds the given tables, returning the ones loaded, as parsed.'''
+    if not tables:
+        return []
+    # Parse the files in worker processes, and load them here, in order.
+    pool = multiprocessing.Pool(min(jobs or len(tables), len(tables)))
+    try:
+        parsed = pool.map(parse_table, tables, 1)
+    finally:
+        pool.terminate()
+    return [t for t in parsed if load_table(cursor, t)]
+
+
+def get_source_hashes(tables=TABLES):
+    '''Returns a dict of the hash of each table's data file.  This script is
+    hashed in as well, since it decides what is built from the files.'''
+    with open(os.path.abspath(__file__), 'rb') as f:
+        builder = hashlib.sha1(f.read())
+    hashes = {}
+    for (tablename, filename) in tables:
+        digest = builder.copy()
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+        hashes[tablename] = digest.hexdigest()
+    return hashes
+
+
+def get_stored_hashes(database):
+    '''Returns a dict of the hashes of the data files the tables of an
+    existing database were built from, or an empty one if there are none.'''
+    if not os.path.isfile(database):
+        return {}
+    con = None
     try:
-        # Open a connection
-        con = None
-
-        # We're starting over, so erase the file.
-        if os.path.isfile(database):
-            os.remove(database)
-        # Open the database file.
         con = sqlite.connect(database)
+        return dict(con.execute('SELECT Data_Table, Hash FROM {0};'.format(
+            SOURCES_TABLE)).fetchall())
+    except sqlite.Error:
+        return {}
+    finally:
+        if con:
+            con.close()
+
 
-        # Build the tables!
-        build_tables(con.cursor())
+def write_sources(cursor, parsed, hashes):
+    '''Records the files the tables were built from, and their hashes.'''
+    cursor.executemany('INSERT INTO {0} VALUES (?,?,?,?);'.format(
+        SOURCES_TABLE), [(t.tablename, t.filename, hashes[t.tablename],
+            '\t'.join(t.metadata)) for t in parsed])
+
+
+def build_payloads(cursor):
+    '''Answers every hoard_types and hoard_budget request that the database
+    can answer, the way webgen.py would.'''
+    encounter = {}
+    for (apl,) in cursor.execute('SELECT "Average Party Level" FROM '
+            'Treasure_Values_Per_Encounter').fetchall():
+        encounter[str(apl)] = dict((rate, dict((magnitude,
+            hoard.calculate_budget_encounter(cursor, apl, rate, magnitude))
+            for magnitude in hoard.MAGNITUDES)) for rate in hoard.RATES)
+    npc_gear = {}
+    for (level,) in cursor.execute('SELECT "Level" FROM NPC_Gear').fetchall():
+        npc_gear[str(level)] = hoard.calculate_budget_npc_gear(cursor, level,
+                False)
+    return {
+            'hoard_types': hoard.get_treasure_list(cursor, 'abcdefghi'),
+            'hoard_budget': {'encounter': encounter, 'npc_gear': npc_gear}
+            }
+
+
+def stage_file(filename, data):
+    '''Writes 'data' to a file beside 'filename', for swap_files to put in
+    its place.  Returns the name of the new file, or None if 'filename'
+    already holds 'data', and is better left alone, so that anything cached
+    from it stays valid.'''
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return None
+    with open(filename + TEMP_SUFFIX, 'wb') as f:
+        f.write(data)
+    return filename + TEMP_SUFFIX
+
+
+def swap_files(staged):
+    '''Puts the files written by stage_file in place.'''
+    for building in staged:
+        filename = building[:-len(TEMP_SUFFIX)]
+        print('Writing ' + filename)
+        os.replace(building, filename)
+
+
+def stage_payloads(cursor, filename):
+    return stage_file(filename, json.dumps(build_payloads(cursor),
+        sort_keys=True).encode('utf-8'))
+
+
+def stage_snapshot(con, filename):
+    # Compile the roll tables, as the item generator would, and save them.
+    item.TABLE_STORE.load(con)
+    building = stage_file(filename, item.TABLE_STORE.dump_snapshot(
+        item.get_data_fingerprint(con)))
+    item.TABLE_STORE.clear()
+    return building
+
+
+def stage_outputs(con, database):
+    '''Precomputes the answers to the hoard requests, and snapshots the roll
+    tables, into files beside the database.  Returns the names of the files
+    that swap_files must put in place, which should be done after the
+    database itself is.'''
+    staged = [stage_snapshot(con, item.get_snapshot_filename(database)),
+            stage_payloads(con.cursor(), os.path.join(
+                os.path.dirname(database), PAYLOAD_FILE))]
+    return [building for building in staged if building]
+
+
+def initialize_database(database, jobs=None, full=False):
+    # Find the tables whose data files have changed since the database was
+    # built, and the ones no longer built at all.  Without a record of the
+    # files, everything is built from scratch.
+    hashes = get_source_hashes()
+    stored = {} if full else get_stored_hashes(database)
+    changed = [(tablename, filename) for (tablename, filename) in TABLES
+            if stored.get(tablename) != hashes[tablename]]
+    removed = [tablename for tablename in stored if tablename not in hashes]
+    # Build new files beside the live ones, so that nothing ever reads a
+    # file that is half built, then swap them into place.
+    building = database + TEMP_SUFFIX
+    staged = []
+    con = None
+    try:
+        if stored and not changed and not removed:
+            print('Database is up to date')
+            # The answers to the hoard requests, and the snapshot, may be
+            # worked out differently than they were, though.
+            con = sqlite.connect(database)
+            staged = stage_outputs(con, database)
+            swap_files(staged)
+            return
+
+        # Erase any file left by a failed build, and start from a copy of the
+        # current database, if only some of its tables are being rebuilt.
+        if os.path.isfile(building):
+            os.remove(building)
+        if stored:
+            shutil.copyfile(database, building)
+        # Open the database file.  Nothing can read it until it is done, so
+        # there is no need for a journal, or to wait for the disk.
+        con = sqlite.connect(building, isolation_level=None)
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+
+        # Build the tables, all in one transaction, dropping the old copies of
+        # the ones being rebuilt.
+        cursor = con.cursor()
+        cursor.execute('BEGIN')
+        cursor.execute('CREATE TABLE IF NOT EXISTS {0} (Data_Table TEXT, '
+                'Source_File TEXT, Hash TEXT, Metadata TEXT);'.format(
+                    SOURCES_TABLE))
+        for tablename in [t[0] for t in changed] + removed:
+            cursor.execute('DROP TABLE IF EXISTS {0};'.format(tablename))
+            cursor.execute('DELETE FROM {0} WHERE Data_Table = ?;'.format(
+                SOURCES_TABLE), (tablename,))
+        parsed = build_tables(cursor, changed, jobs)
+        write_sources(cursor, parsed, hashes)
+        cursor.execute('COMMIT')
+
+        # Gather statistics for the query planner, and pack the file, which
+        # is only read from now on.
+        con.execute('ANALYZE')
+        con.execute('VACUUM')
+
+        # Precompute what only depends on the tables.
+        staged = stage_outputs(con, database)
+        con.close()
+        con = None
 
-        # Commit
-        con.commit()
+        # Put the finished database in place of the old one, and only then
+        # the files worked out from it, so they never describe a database
+        # that isn't there.
+        os.replace(building, database)
+        swap_files(staged)
 
-    except sqlite.Error as e:
-        print('Error: %s' % e.message)
+    except FileFormatError as e:
+        print(e)
+        sys.exit(1)
+    except (sqlite.Error, EnvironmentError) as e:
+        print('Error: %s' % e)
         sys.exit(1)
     finally:
         if con:
             con.close()
+        # Unless they were swapped into place, the new files are no use.
+        for filename in [building] + staged:
+            if os.path.isfile(filename):
+                os.remove(filename)
 
 #
 # Main
@@ -356,8 +557,18 @@ if __name__ == '__main__':
     parser.add_argument('database', metavar='DATABASE',
             help='The database name')
 
+    # Whether to rebuild every table, rather than only those whose data
+    # files have changed.
+    parser.add_argument('--full', '-f', action='store_true',
+            help='Rebuild every table, even if its data file is unchanged')
+
+    # Number of processes parsing the files
+    parser.add_argument('--jobs', '-j', type=int,
+            default=multiprocessing.cpu_count(),
+            help='The number of processes parsing the files at once')
+
     # We'll ask for the password when we execute.
 
     # Go.
     args = parser.parse_args()
-    initialize_database(args.database)
+    initialize_database(args.database, args.jobs, args.full)
@@ -191,6 +191,18 @@ function get_form_data(form_id, mode) {
 // Send an AJAX request.  Well, AJAJ, really.
 function send_request(json_string, handler) {
     //console.log("send: %s", json_string);
+    // Answers that only change with the data are asked for with GET, so the
+    // browser can keep them, and only check that they haven't changed.
+    var params = JSON.parse(json_string);
+    if (params.mode == "hoard_types" || params.mode == "hoard_budget") {
+        $.ajax({
+            type: "GET",
+            url: "../cgi-bin/pf_items/webgen.py",
+            data: params,
+            success: handler
+        });
+        return;
+    }
     $.ajax({
         type: "POST",
         url: "../cgi-bin/pf_items/webgen.py",